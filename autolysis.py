@@ -1,9 +1,8 @@
 # /// script
 # requires-python = ">=3.12"
 # dependencies = [
-#   "httpx",
+#   "httpx[http2]",
 #   "pandas",
-#   "requests",
 #   "numpy",
 #   "seaborn",
 #   "chardet",
@@ -11,33 +10,47 @@
 #   "geopandas",
 #   "scipy",
 #   "matplotlib",
+#   "pyarrow",
 # ]
 # ///
 
+import time
+IMPORT_START = time.perf_counter()
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
 import chardet
-import requests
+import httpx
 import os
 import json
 import sys
 import traceback
 import io
 import base64
-from sklearn.impute import SimpleImputer
-from sklearn.compose import ColumnTransformer
-import geopandas as gpd
-from scipy.stats import zscore
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
-from sklearn.decomposition import PCA
-from functools import lru_cache
+import hashlib
+import pickle
+import glob
+import contextvars
+import contextlib
+import tempfile
+import random
+import signal
+import threading
+import importlib
+import importlib.util
+import inspect
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from email.utils import parsedate_to_datetime
+# scipy, sklearn, matplotlib, seaborn and geopandas are imported by the stages that use them, see importModule
+# Charts are rendered off screen, also in the spawned chart workers
+os.environ["MPLBACKEND"] = "Agg"
+IMPORT_TIMES = {"startup": {"eager imports": time.perf_counter() - IMPORT_START}}
 
 
 AIPROXY_TOKEN = os.getenv("AIPROXY_TOKEN")
-MAX_RETRY = os.getenv("MAX_RETRY", 3)
+MAX_RETRY = int(os.getenv("MAX_RETRY", 3))
 AIPROXY_URL = os.getenv("AISERVER_URL","https://aiproxy.sanand.workers.dev/openai/v1/chat/completions")
 MODEL = os.getenv("AI_MODEL","gpt-4o-mini")
 HEADERS = {
@@ -45,6 +58,109 @@ HEADERS = {
     'Content-Type': 'application/json'
 }
 OUTPUT_FILE = "README.md"
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", 10))
+READ_TIMEOUT = float(os.getenv("READ_TIMEOUT", 120))
+BACKOFF_BASE = float(os.getenv("BACKOFF_BASE", 1))
+BACKOFF_MAX = float(os.getenv("BACKOFF_MAX", 30))
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# http posts to the LLM, record also stores every exchange in LLM_RECORD_DIR and replay serves the stored
+# exchanges without network, sleeping the recorded latency times REPLAY_LATENCY_SCALE
+LLM_TRANSPORT = os.getenv("LLM_TRANSPORT", "http")
+# Token budget of the user content per function, PROMPT_BUDGETS overrides them as name:tokens pairs
+PROMPT_BUDGETS = {"get_intro_stats_summary": 4000, "get_code_for_analysis": 4000, "get_narrative": 6000,
+                  **{name: int(tokens) for name, tokens in (item.split(":") for item in os.getenv("PROMPT_BUDGETS", "").split(",") if item)}}
+PROMPT_FLOAT_DIGITS = int(os.getenv("PROMPT_FLOAT_DIGITS", 4))
+# Characters per token of JSON and English text, close enough for budgeting without a tokenizer
+CHARS_PER_TOKEN = 4
+# Charts are sent to the vision model fit in IMAGE_MAX_SIZE pixels, the size detail low images are scaled to,
+# and cost IMAGE_TOKENS tokens whatever their size. INSIGHT_WORKERS charts are sent at the same time
+IMAGE_MAX_SIZE = int(os.getenv("IMAGE_MAX_SIZE", 512))
+IMAGE_TOKENS = 85
+INSIGHT_WORKERS = int(os.getenv("INSIGHT_WORKERS", 4))
+REPLAY_LATENCY_SCALE = float(os.getenv("REPLAY_LATENCY_SCALE", 0))
+IO_WORKERS = int(os.getenv("IO_WORKERS", 4))
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", os.cpu_count() or 1))
+# Batch mode, datasets analysed at the same time and the directory holding one output directory per dataset
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 2))
+BATCH_OUTPUT_DIR = os.getenv("BATCH_OUTPUT_DIR", "output")
+STREAMING_MODE = os.getenv("STREAMING_MODE", "auto")
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", 1024))
+SAMPLE_ROWS = int(os.getenv("SAMPLE_ROWS", 100000))
+SKETCH_SIZE = int(os.getenv("SKETCH_SIZE", 2048))
+ENCODING_HEAD_BYTES = int(os.getenv("ENCODING_HEAD_BYTES", 1024 * 1024))
+ENCODING_BLOCK_BYTES = 64 * 1024
+ENCODING_SAMPLE_BLOCKS = 8
+# Rows per record batch of the sidecar written by in-memory runs, streaming runs read the sidecar batch by batch
+SIDECAR_BATCH_ROWS = 65536
+CATEGORY_MAX_RATIO = float(os.getenv("CATEGORY_MAX_RATIO", 0.5))
+BOOLEAN_VALUES = {'true': True, 'false': False, 'yes': True, 'no': False, 'y': True, 'n': False,
+                  't': True, 'f': False, '1': True, '0': False}
+# Columns per get_column_dtypes request, the requests of a table run concurrently on METADATA_WORKERS threads
+METADATA_CHUNK_COLUMNS = int(os.getenv("METADATA_CHUNK_COLUMNS", 40))
+METADATA_WORKERS = int(os.getenv("METADATA_WORKERS", 4))
+# Column types answered from the first LOCAL_SAMPLE_ROWS values without asking LLM, datetime, boolean
+# and numeric, numeric columns answered locally get no minimum value
+LOCAL_TYPES = {kind.strip() for kind in os.getenv("LOCAL_TYPES", "datetime,boolean").split(",") if kind.strip()}
+LOCAL_SAMPLE_ROWS = int(os.getenv("LOCAL_SAMPLE_ROWS", 1000))
+CLUSTER_K_MIN = int(os.getenv("CLUSTER_K_MIN", 2))
+CLUSTER_K_MAX = int(os.getenv("CLUSTER_K_MAX", 10))
+CLUSTER_SAMPLE_ROWS = int(os.getenv("CLUSTER_SAMPLE_ROWS", 50000))
+CLUSTER_CHUNK_ROWS = 100000
+SILHOUETTE_SAMPLE_ROWS = int(os.getenv("SILHOUETTE_SAMPLE_ROWS", 5000))
+SCATTER_MAX_ROWS = int(os.getenv("SCATTER_MAX_ROWS", 20000))
+DENSITY_BINS = 200
+CORRELATION_METHOD = os.getenv("CORRELATION_METHOD", "pearson")
+CORRELATION_TOP_K = int(os.getenv("CORRELATION_TOP_K", 50))
+CORRELATION_BLOCK_COLUMNS = 256
+HEATMAP_MAX_COLUMNS = int(os.getenv("HEATMAP_MAX_COLUMNS", 30))
+OUTLIER_METHOD = os.getenv("OUTLIER_METHOD", "zscore")
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", 2))
+# Limits of the child process running generated code
+CODE_TIMEOUT = float(os.getenv("CODE_TIMEOUT", 120))
+CODE_CPU_SECONDS = int(os.getenv("CODE_CPU_SECONDS", 60))
+CODE_MAX_RSS_MB = float(os.getenv("CODE_MAX_RSS_MB", 2048))
+CACHE_DIR = os.getenv("CACHE_DIR", ".llm_cache")
+CACHE_MAX_SIZE_MB = float(os.getenv("CACHE_MAX_SIZE_MB", 50))
+CACHE_MAX_AGE_DAYS = float(os.getenv("CACHE_MAX_AGE_DAYS", 7))
+DATASET_CACHE_MAX_SIZE_MB = float(os.getenv("DATASET_CACHE_MAX_SIZE_MB", 10240))
+CACHE_DISABLED = os.getenv("DISABLE_CACHE", "0") == "1"
+LLM_RECORD_DIR = os.getenv("LLM_RECORD_DIR", os.path.join(CACHE_DIR, "recordings"))
+STAGE_CACHE_MAX_SIZE_MB = float(os.getenv("STAGE_CACHE_MAX_SIZE_MB", 1024))
+# Stages recomputed even when their stored result is still valid, "all" for every stage
+FORCE_STAGES = {name.strip() for name in os.getenv("FORCE_STAGES", "").split(",") if name.strip()}
+# Stages holding the dataset itself are not stored, the Arrow sidecar already caches it
+UNCACHED_STAGES = {"sidecarInfo", "rawDf", "df", "preprocessed", "source", "ingested"}
+# Settings that change the result of each stage, part of its key together with the code it runs
+LLM_SETTINGS = ["MODEL", "PROMPT_BUDGETS", "PROMPT_FLOAT_DIGITS"]
+STAGE_SETTINGS = {
+    "rawDf": ["SAMPLE_ROWS"],
+    "featureInfo": ["MODEL", "MAX_RETRY", "METADATA_CHUNK_COLUMNS", "LOCAL_TYPES", "LOCAL_SAMPLE_ROWS"],
+    "df": ["CATEGORY_MAX_RATIO"],
+    "statsInfo": ["SKETCH_SIZE"],
+    "preprocessed": ["SAMPLE_ROWS"],
+    "correlationInfo": ["CORRELATION_METHOD", "CORRELATION_TOP_K", "HEATMAP_MAX_COLUMNS"],
+    "outliersInfo": ["OUTLIER_METHOD", "SKETCH_SIZE", "SAMPLE_ROWS"],
+    "summaryInfo": LLM_SETTINGS,
+    "clusterInfo": ["CLUSTER_K_MIN", "CLUSTER_K_MAX", "CLUSTER_SAMPLE_ROWS", "SILHOUETTE_SAMPLE_ROWS", "SCATTER_MAX_ROWS", "DENSITY_BINS"],
+    "analysisSummary": LLM_SETTINGS + ["MAX_RETRY"],
+    "insights": ["MODEL", "IMAGE_MAX_SIZE"],
+    "narrative": LLM_SETTINGS,
+}
+_CODE_HASHES = {}
+IMPORT_TIME_REPORT = os.getenv("IMPORT_TIME_REPORT") == "1"
+# Directory the trace of the run is written to as JSON and as a Chrome trace, no trace files if not set
+TRACE_DIR = os.getenv("TRACE_DIR")
+TRACE_EVENTS = []
+_TRACE_LOCK = threading.Lock()
+# Modules generated code may use without importing them, imported only when the code refers to them
+CODE_MODULES = {"plt": "matplotlib.pyplot", "sns": "seaborn", "gpd": "geopandas"}
+_STAGE = threading.local()
+# Output directory of the dataset being analysed, copied into the stages it runs
+_OUTPUT_DIR = contextvars.ContextVar("output_dir", default=".")
+_DATASET = contextvars.ContextVar("dataset", default="")
+_IMPORT_LOCK = threading.Lock()
+CACHE_STATS = {"hits": 0, "misses": 0}
+_CACHE_LOCK = threading.Lock()
 
 FUNCTIONS_DESCRIPTIONS_DICT = {
     'get_column_dtypes': [
@@ -283,17 +399,56 @@ CONCLUSION_PROMPT = (
 )
 
 
+def getFileFingerprint(filename):
+    '''
+    Method to get a fingerprint of the file that changes whenever the file is modified
+    Args:
+        filename: str: path to the file
+    Returns:
+        str: hash of the absolute path, size and modification time of the file
+    '''
+    stat = os.stat(filename)
+    return getCacheKey([os.path.abspath(filename), stat.st_size, stat.st_mtime_ns])
+
 def getFileEncoding(filename):
     '''
-    Method to get the file encoding to load using pandas
+    Method to get the file encoding to load using pandas, detected from the head and a few blocks of the
+    file and cached per path, size and modification time
     Args: 
         filename: str: path to the file
     Returns:  
         str: encoding of the file
     '''
-    with open(filename,"rb") as f:
-        content = f.read() 
-        return chardet.detect(content)['encoding']
+    stat = os.stat(filename)
+    key = getCacheKey({'encoding': getFileFingerprint(filename)})
+    cached = None if CACHE_DISABLED else readCache(key)
+    if cached is not None:
+        return cached['encoding']
+
+    detector = chardet.UniversalDetector()
+    with traceSpan("encoding detection", "io"), open(filename,"rb") as f:
+        # Feed the head of the file until the detector is confident
+        fed = 0
+        while not detector.done and fed < ENCODING_HEAD_BYTES:
+            block = f.read(ENCODING_BLOCK_BYTES)
+            if not block:
+                break
+            detector.feed(block)
+            fed += len(block)
+        # Then a few blocks spread over the rest of the file
+        if not detector.done and stat.st_size > fed:
+            for offset in np.linspace(fed, stat.st_size - ENCODING_BLOCK_BYTES, ENCODING_SAMPLE_BLOCKS).astype(int):
+                f.seek(max(int(offset), fed))
+                detector.feed(f.read(ENCODING_BLOCK_BYTES))
+                if detector.done:
+                    break
+    encoding = detector.close()['encoding']
+    # An ascii head does not rule out non-ascii bytes further down, utf-8 reads ascii identically
+    if encoding is None or encoding.lower() == 'ascii':
+        encoding = 'utf-8'
+    if not CACHE_DISABLED:
+        writeCache(key, {'encoding': encoding})
+    return encoding
 
 
 def getFunctionDescriptions(functionName):
@@ -323,6 +478,48 @@ def readImage(imagefile):
         print(f"Error moving file: {e}")    
     return image_data
 
+_IMAGE_URLS = {}
+_IMAGE_LOCK = threading.Lock()
+
+def encodeImage(image_data):
+    '''
+    Method to downscale an image to fit IMAGE_MAX_SIZE and recompress it as an optimized 256 colour PNG
+    Args:
+        image_data: bytes: image file content
+    Returns:
+        bytes: PNG image data
+    '''
+    Image = importModule("PIL.Image")
+    with Image.open(io.BytesIO(image_data)) as image:
+        image = image.convert("RGB")
+        image.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE))
+        buffer = io.BytesIO()
+        image.quantize(colors=256).save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+def getImageUrl(imageFile):
+    '''
+    Method to get the data URL of an image downscaled for the vision model, encoded once per image content
+    Args:
+        imageFile: str: path to the image file
+    Returns:
+        str: base64 data URL of the image
+    '''
+    image_data = readImage(imageFile)
+    key = hashlib.sha256(image_data).hexdigest()
+    with _IMAGE_LOCK:
+        image_url = _IMAGE_URLS.get(key)
+    if image_url is None:
+        try:
+            encoded, mime_type = encodeImage(image_data), "image/png"
+        except Exception as e:
+            print(f"Error: {e}")
+            encoded, mime_type = image_data, "image/png" if imageFile.endswith(".png") else "image/jpeg"
+        image_url = f"data:{mime_type};base64,{base64.b64encode(encoded).decode('utf-8')}"
+        with _IMAGE_LOCK:
+            _IMAGE_URLS[key] = image_url
+    return image_url
+
 def createMessagePayload(instruction, userContent, imageFile):
     '''
     Method to create the message payload to be passed to LLM, including the image
@@ -339,10 +536,7 @@ def createMessagePayload(instruction, userContent, imageFile):
             {'role':'user','content':userContent}
         ]
     else:
-        image_data = readImage(imageFile)
-        mime_type = "image/png" if imageFile.endswith(".png") else "image/jpeg"
-        base64_image = base64.b64encode(image_data).decode('utf-8')
-        image_url = f"data:{mime_type};base64,{base64_image}"
+        image_url = getImageUrl(imageFile)
         return [{
                 'role':'user',
                 'content': [{'type':'text','text':instruction},{'type':'image_url','image_url':{'detail':'low','url':image_url}}]
@@ -368,20 +562,470 @@ def getPayload(instruction, userContent, functionName, imageFile = ""):
     } 
     return json_data
 
-@lru_cache(maxsize=5)
-def handleRequest(instruction, userContent, functionName):
+def importModule(name):
+    '''
+    Method to import a module on first use and record the import time against the running stage
+    Args:
+        name: str: module name
+    Returns:
+        module: imported module
+    '''
+    module = sys.modules.get(name)
+    # A module is in sys.modules before its body has run, one still being imported by another thread
+    # goes through import_module, which waits for the import to finish
+    if module is not None and not getattr(getattr(module, "__spec__", None), "_initializing", False):
+        return module
+    loaded = module is not None
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if loaded:
+        return module
+    # Time includes the dependencies not yet imported, like the cumulative column of -X importtime
+    with _IMPORT_LOCK:
+        IMPORT_TIMES.setdefault(getattr(_STAGE, "name", "main"), {}).setdefault(name, time.perf_counter() - start)
+    return module
+
+def printImportReport():
+    '''
+    Method to print the import time of every module grouped by the stage that imported it
+    '''
+    print("Import time per stage:")
+    for stage, modules in IMPORT_TIMES.items():
+        print(f"  {stage}: {sum(modules.values()):.3f}s")
+        for name, seconds in sorted(modules.items(), key=lambda item: -item[1]):
+            print(f"    {name}: {seconds:.3f}s")
+
+def getPeakRss():
+    '''
+    Method to get the peak resident memory of this process
+    Returns:
+        float: peak resident memory in MB, 0 where the resource module is not available
+    '''
+    if importlib.util.find_spec("resource") is None:
+        return 0
+    resource = importModule("resource")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kB on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def addTraceEvent(event):
+    '''
+    Method to add an event to the trace of the run
+    Args:
+        event: dict: name, category, dataset, thread, start and wall seconds and details
+    '''
+    with _TRACE_LOCK:
+        TRACE_EVENTS.append(event)
+
+@contextlib.contextmanager
+def traceSpan(name, category, **details):
+    '''
+    Method to trace a block with its wall time, CPU time of the thread and growth of the peak resident memory
+    Args:
+        name: str: event name
+        category: str: stage, llm, io, compute or chart
+        details: dict: details of the event, the block can add more to the yielded event
+    '''
+    event = {"name": name, "category": category, "dataset": _DATASET.get(), "thread": threading.current_thread().name, **details}
+    start, cpuStart, rssStart = time.perf_counter(), time.thread_time(), getPeakRss()
+    try:
+        yield event
+    finally:
+        event.update(start=round(start - IMPORT_START, 6), wall=round(time.perf_counter() - start, 6),
+                     cpu=round(time.thread_time() - cpuStart, 6), peak_rss_delta_mb=round(getPeakRss() - rssStart, 3))
+        addTraceEvent(event)
+
+def getFrameShape(value):
+    '''
+    Method to get the rows and columns of the dataframe in a stage result
+    Args:
+        value: object: stage result, a dataframe or a tuple starting with one
+    Returns:
+        tuple: rows, columns or None if the result holds no dataframe
+    '''
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    return value.shape if isinstance(value, pd.DataFrame) else None
+
+def exportTrace(directory):
+    '''
+    Method to write the trace of the run as trace.json and as chrome_trace.json, loadable in
+    chrome://tracing or Perfetto
+    Args:
+        directory: str: directory the files are written to
+    '''
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with _TRACE_LOCK:
+            events = sorted(TRACE_EVENTS, key=lambda event: event["start"])
+        with open(os.path.join(directory, "trace.json"), "w") as f:
+            json.dump({"events": events}, f, indent=2, default=str)
+        threads = {name: idx for idx, name in enumerate(dict.fromkeys(event["thread"] for event in events))}
+        traceEvents = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}} for name, tid in threads.items()]
+        traceEvents += [{
+            "name": event["name"], "cat": event["category"], "ph": "X", "pid": os.getpid(), "tid": threads[event["thread"]],
+            "ts": event["start"] * 1e6, "dur": event["wall"] * 1e6,
+            "args": {key: value for key, value in event.items() if key not in ("name", "category", "thread", "start", "wall")}
+        } for event in events]
+        with open(os.path.join(directory, "chrome_trace.json"), "w") as f:
+            json.dump({"traceEvents": traceEvents, "displayTimeUnit": "ms"}, f, default=str)
+        print(f"Trace written to {directory}")
+    except OSError as e:
+        print(f"Error writing trace: {e}")
+
+def getOutputPath(name):
+    '''
+    Method to get the path of an output file in the output directory of the dataset being analysed
+    Args:
+        name: str: file name, as linked from the README
+    Returns:
+        str: path of the file
+    '''
+    return os.path.join(_OUTPUT_DIR.get(), name)
+
+def getCacheKey(json_data):
+    '''
+    Method to get the cache key for a payload, a hash of the model, messages and functions
+    Args:
+        json_data: dict: payload to be passed to LLM
+    Returns:
+        str: sha256 hex digest of the payload
+    '''
+    content = json.dumps(json_data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def removeFile(path):
+    '''
+    Method to remove a file, ignoring files already removed by another worker
+    Args:
+        path: str: path to the file
+    '''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def evictCache(directory=CACHE_DIR, maxSizeMB=CACHE_MAX_SIZE_MB):
+    '''
+    Method to remove cache entries older than CACHE_MAX_AGE_DAYS and the least recently used
+    entries beyond the size limit
+    Args:
+        directory: str: cache directory, sub directories are not evicted
+        maxSizeMB: float: size limit of the directory in MB
+    '''
+    if not os.path.isdir(directory):
+        return
+    now = time.time()
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # Skip sub directories and entries still being written
+        if not os.path.isfile(path) or name.endswith('.tmp'):
+            continue
+        if now - stat.st_mtime > CACHE_MAX_AGE_DAYS * 86400:
+            removeFile(path)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= maxSizeMB * 1024 * 1024:
+            break
+        removeFile(path)
+        total_size -= size
+
+def readCache(key):
+    '''
+    Method to read a response from the on-disk cache
+    Args:
+        key: str: cache key
+    Returns:
+        dict: cached response or None if not cached
+    '''
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, "r") as f:
+            response = json.load(f)
+        # Touch the entry so that size based eviction drops least recently used entries first
+        os.utime(path)
+        return response
+    except (OSError, ValueError):
+        return None
+
+def writeCache(key, response):
+    '''
+    Method to write a response to the on-disk cache
+    Args:
+        key: str: cache key
+        response: dict: response from LLM
+    '''
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, f"{key}.json")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(response, f)
+        os.replace(tmp_path, path)
+        evictCache()
+    except OSError as e:
+        print(f"Error writing cache: {e}")
+
+_HTTP_CLIENT = None
+_HTTP_CLIENT_LOCK = threading.Lock()
+
+def getHttpClient():
+    '''
+    Method to get the pooled HTTP client shared by all LLM calls, created on first use
+    Returns:
+        httpx.Client: keep-alive client with connect and read timeouts
+    '''
+    global _HTTP_CLIENT
+    with _HTTP_CLIENT_LOCK:
+        if _HTTP_CLIENT is None:
+            _HTTP_CLIENT = httpx.Client(
+                headers=HEADERS,
+                timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                # HTTP/2 needs the optional h2 package, fall back to HTTP/1.1 keep-alive without it
+                http2=importlib.util.find_spec("h2") is not None
+            )
+        return _HTTP_CLIENT
+
+def getRetryDelay(response, attempt):
+    '''
+    Method to get the delay before the next retry, honouring the Retry-After header if present
+    Args:
+        response: httpx.Response: failed response or None for transport errors
+        attempt: int: zero based retry attempt
+    Returns:
+        float: delay in seconds
+    '''
+    retryAfter = response.headers.get("Retry-After") if response is not None else None
+    if retryAfter:
+        try:
+            return min(float(retryAfter), BACKOFF_MAX)
+        except ValueError:
+            try:
+                return min(max(parsedate_to_datetime(retryAfter).timestamp() - time.time(), 0), BACKOFF_MAX)
+            except (TypeError, ValueError):
+                pass
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def postRequest(json_data):
+    '''
+    Method to post the payload to LLM, retrying timeouts, connection errors and retryable status codes
+    Args:
+        json_data: dict: payload to be passed to LLM
+    Returns:
+        dict: response from LLM in JSON format
+    '''
+    client = getHttpClient()
+    attempt = 0
+    while True:
+        try:
+            response = client.post(AIPROXY_URL, json=json_data)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= MAX_RETRY:
+                return response.json()
+        except httpx.TransportError as e:
+            if attempt >= MAX_RETRY:
+                raise
+            print(f"Error: {e}, retrying")
+            response = None
+        else:
+            print(f"Error: status {response.status_code}, retrying")
+        time.sleep(getRetryDelay(response, attempt))
+        attempt += 1
+
+def getRecordingPath(json_data):
+    '''
+    Method to get the path of the recorded exchange of a payload
+    Args:
+        json_data: dict: payload to be passed to LLM
+    Returns:
+        str: path of the recording
+    '''
+    return os.path.join(LLM_RECORD_DIR, f"{getCacheKey(json_data)}.json")
+
+def recordRequest(json_data):
+    '''
+    Method to post the payload to LLM and record the request, response, function name and latency
+    Args:
+        json_data: dict: payload to be passed to LLM
+    Returns:
+        dict: response from LLM in JSON format
+    '''
+    start = time.perf_counter()
+    response = postRequest(json_data)
+    recording = {"function": json_data['function_call']['name'], "latency": time.perf_counter() - start,
+                 "request": json_data, "response": response}
+    try:
+        os.makedirs(LLM_RECORD_DIR, exist_ok=True)
+        path = getRecordingPath(json_data)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(recording, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error recording request: {e}")
+    return response
+
+def replayRequest(json_data):
+    '''
+    Method to serve the recorded response of the payload, after the recorded latency times REPLAY_LATENCY_SCALE
+    Args:
+        json_data: dict: payload to be passed to LLM
+    Returns:
+        dict: recorded response from LLM
+    '''
+    try:
+        with open(getRecordingPath(json_data), "r") as f:
+            recording = json.load(f)
+    except FileNotFoundError:
+        raise LookupError(f"No recording of {json_data['function_call']['name']} for this payload in {LLM_RECORD_DIR}")
+    time.sleep(recording["latency"] * REPLAY_LATENCY_SCALE)
+    return recording["response"]
+
+TRANSPORTS = {"http": postRequest, "record": recordRequest, "replay": replayRequest}
+
+def estimateTokens(text):
+    '''
+    Method to estimate the number of tokens of a text
+    Args:
+        text: str: text sent to LLM
+    Returns:
+        int: estimated number of tokens
+    '''
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def compactValue(value):
+    '''
+    Method to convert a value to plain JSON types with floats rounded to PROMPT_FLOAT_DIGITS significant digits
+    Args:
+        value: object: dict, list, dataframe, numpy or plain value
+    Returns:
+        object: JSON serializable value
+    '''
+    if isinstance(value, pd.DataFrame):
+        return [compactValue(record) for record in value.to_dict(orient='records')]
+    if isinstance(value, pd.Series):
+        return compactValue(value.to_dict())
+    if isinstance(value, dict):
+        return {str(key): compactValue(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [compactValue(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return None if np.isnan(value) else float(f"{value:.{PROMPT_FLOAT_DIGITS}g}")
+    return value if isinstance(value, (int, str, bool, type(None))) else str(value)
+
+def shrinkValue(value, excess):
+    '''
+    Method to leave out the last entries of the outermost dict or list of a value, noting how many were left out
+    Args:
+        value: object: compact value
+        excess: int: number of characters to save
+    Returns:
+        object: smaller value, or the value itself if nothing can be left out
+    '''
+    if isinstance(value, dict):
+        omitted = value.get("...", 0)
+        items = [(key, item) for key, item in value.items() if key != "..."]
+        if len(items) <= 1:
+            return {key: shrinkValue(item, excess) for key, item in items} | ({"...": omitted} if omitted else {})
+        keep = len(items) - 1
+        saved = len(json.dumps(dict(items[keep:])))
+        while keep > 1 and saved < excess:
+            keep -= 1
+            saved += len(json.dumps(dict([items[keep]])))
+        return {**dict(items[:keep]), "...": omitted + len(items) - keep}
+    if isinstance(value, list) and len(value) > 1:
+        omitted = int(value[-1].split()[1]) if isinstance(value[-1], str) and value[-1].startswith("... ") else 0
+        items = value[:-1] if omitted else value
+        keep = len(items) - 1
+        saved = len(json.dumps(items[keep:]))
+        while keep > 1 and saved < excess:
+            keep -= 1
+            saved += len(json.dumps(items[keep]))
+        return items[:keep] + [f"... {omitted + len(items) - keep} more"]
+    return value
+
+def buildPrompt(functionName, sections):
+    '''
+    Method to build the user content of a request from labelled sections as minified JSON, leaving out
+    the last entries of the largest section until the content fits the token budget of the function
+    Args:
+        functionName: str: name of the function to be called
+        sections: list: (label, value) pairs, the first entries are kept in full the longest
+    Returns:
+        str: user content
+    '''
+    budget = PROMPT_BUDGETS.get(functionName)
+    values = [compactValue(value) for _, value in sections]
+    render = lambda: "\n".join(f"{label}:{json.dumps(value, separators=(',', ':'))}" for (label, _), value in zip(sections, values))
+    content = render()
+    pruned = False
+    while budget and estimateTokens(content) > budget:
+        idx = max(range(len(values)), key=lambda idx: len(json.dumps(values[idx])))
+        smaller = shrinkValue(values[idx], len(content) - budget * CHARS_PER_TOKEN)
+        if smaller == values[idx]:
+            # Nothing left to prune, cut the content at the budget
+            content = content[:budget * CHARS_PER_TOKEN]
+            break
+        values[idx] = smaller
+        content = render()
+        pruned = True
+    if pruned:
+        print(f"Prompt {functionName} pruned to fit {budget} tokens")
+    return content
+
+def getColumnTypes(df):
+    '''
+    Method to get the column names and dtypes for a prompt
+    Args:
+        df: DataFrame: dataframe to be analyzed
+    Returns:
+        dict: column -> dtype
+    '''
+    return {column: str(dtype) for column, dtype in df.dtypes.items()}
+
+def handleRequest(instruction, userContent, functionName, useCache=True, imageFile=""):
     '''
-    Method to call LLM
+    Method to call LLM through the LLM_TRANSPORT, responses are served from the on-disk cache when available
     Args:
         instruction: str: instruction to be passed to LLM
         userContent: str: user content to be passed to LLM
         functionName: str: name of the function to be called
+        useCache: bool: set False to bypass the cache for this call
+        imageFile: str: path to an image attached to the instruction instead of the user content
     Returns:
         dict: response from LLM in JSON format
     '''
-    json_data = getPayload(instruction, userContent, functionName)
-    response = requests.post(AIPROXY_URL,headers=HEADERS,json=json_data)
-    return response.json()
+    json_data = getPayload(instruction, userContent, functionName, imageFile)
+    # Recording and replaying go through the transport for every call
+    useCache = useCache and not CACHE_DISABLED and not getattr(_STAGE, "force", False) and LLM_TRANSPORT == "http"
+    key = getCacheKey(json_data)
+    # The base64 image is billed as a fixed number of tokens, not by its length
+    estimated = estimateTokens(json.dumps(json_data['messages'])) if imageFile == "" else estimateTokens(instruction) + IMAGE_TOKENS
+    print(f"Prompt {functionName}: {len(json.dumps(json_data))} bytes, ~{estimated} tokens")
+    with traceSpan(f"llm {functionName}", "llm", transport=LLM_TRANSPORT, request_bytes=len(json.dumps(json_data)), estimated_tokens=estimated) as event:
+        response = readCache(key) if useCache else None
+        if useCache:
+            with _CACHE_LOCK:
+                CACHE_STATS["hits" if response is not None else "misses"] += 1
+        event["cached"] = response is not None
+        if response is None:
+            response = TRANSPORTS[LLM_TRANSPORT](json_data)
+            # Cache only successful responses, errors should be retried on the next run
+            if useCache and 'choices' in response:
+                writeCache(key, response)
+        event["response_bytes"] = len(json.dumps(response))
+        event.update({name: count for name, count in response.get('usage', {}).items() if name.endswith('_tokens')})
+    return response
 
 def loadFile(fileName):
     '''
@@ -393,35 +1037,312 @@ def loadFile(fileName):
     '''
     try:
         encoding = getFileEncoding(fileName)
-        df = pd.read_csv(fileName, encoding=encoding)
+        with traceSpan("csv parse", "io") as event:
+            df = pd.read_csv(fileName, encoding=encoding)
+            event["rows"], event["columns"] = df.shape
+        return df
+    except Exception as e:
+        print(f"Error: {e}")
+
+def applyColumnTypes(df, featureInfo, downcast=True):
+    '''
+    Method to apply the column types inferred by LLM, numeric columns are parsed as numbers and downcast
+    to the smallest width that holds their values, datetime columns are parsed as timestamps, boolean
+    columns stored as bool and low cardinality strings as category. Values that cannot be parsed become NaN
+    Args:
+        df: DataFrame: dataframe loaded from the file
+        featureInfo: dict: feature information
+        downcast: bool: set False to keep 64 bit numbers and plain strings, so that separately typed
+            chunks share the same dtypes
+    Returns:
+        DataFrame: typed dataframe
+    '''
+    df = df.copy(deep=False)
+    for item in featureInfo:
+        col, kind = item['name'], item.get('type')
+        if col not in df.columns:
+            continue
+        values = df[col]
+        if kind in ('integer', 'float'):
+            if not pd.api.types.is_numeric_dtype(values):
+                values = pd.to_numeric(values, errors='coerce')
+            if downcast and pd.api.types.is_integer_dtype(values) and not pd.api.types.is_bool_dtype(values):
+                values = pd.to_numeric(values, downcast='integer')
+            elif downcast and pd.api.types.is_float_dtype(values) and values.dtype != np.float32:
+                # pandas accepts float32 when the values are only close, keep 64 bits unless every value round-trips exactly
+                narrow = values.astype(np.float32)
+                if narrow.astype(np.float64).equals(values.astype(np.float64)):
+                    values = narrow
+        elif kind == 'datetime' and not pd.api.types.is_datetime64_any_dtype(values):
+            values = pd.to_datetime(values, errors='coerce', format='mixed')
+        elif kind == 'boolean' and not pd.api.types.is_bool_dtype(values):
+            mapped = values.astype(str).str.strip().str.lower().map(BOOLEAN_VALUES)
+            # Leave the column alone if it holds anything but boolean tokens
+            if mapped.notna().sum() == values.notna().sum():
+                values = mapped.astype(bool) if mapped.notna().all() else mapped.astype('boolean')
+        elif downcast and kind in ('string', 'object') and (pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)):
+            if values.nunique() <= CATEGORY_MAX_RATIO * len(values):
+                values = values.astype('category')
+        df[col] = values
+    return df
+
+def reportMemoryUsage(before, after):
+    '''
+    Method to print the memory used by each column before and after typing
+    Args:
+        before: DataFrame: dataframe as parsed from the file
+        after: DataFrame: typed dataframe
+    '''
+    beforeUsage = before.memory_usage(index=False, deep=True)
+    afterUsage = after.memory_usage(index=False, deep=True)
+    print(f"{'Column':<30} {'Before':>12} {'After':>12}  Dtype")
+    for col in after.columns:
+        print(f"{str(col)[:30]:<30} {beforeUsage.get(col, 0):>12,} {afterUsage[col]:>12,}  {before[col].dtype} -> {after[col].dtype}")
+    print(f"{'Total':<30} {beforeUsage.sum():>12,} {afterUsage.sum():>12,}")
+
+def getSidecarPath(fileName):
+    '''
+    Method to get the path of the Arrow sidecar of a file
+    Args:
+        fileName: str: path to the file
+    Returns:
+        str: path of the sidecar in the cache directory, keyed by the file fingerprint
+    '''
+    return os.path.join(CACHE_DIR, "datasets", f"{getFileFingerprint(fileName)}.arrow")
+
+def openSidecar(fileName):
+    '''
+    Method to open the Arrow sidecar of a file, memory-mapped so that only the pages read are loaded
+    Args:
+        fileName: str: path to the file
+    Returns:
+        RecordBatchFileReader: reader of the sidecar, None if there is no sidecar
+    '''
+    path = getSidecarPath(fileName)
+    if CACHE_DISABLED or not os.path.exists(path):
+        return None
+    reader = pa.ipc.open_file(pa.memory_map(path, 'r'))
+    os.utime(path)
+    return reader
+
+def getSidecarFeatureInfo(fileName):
+    '''
+    Method to get the feature information stored with the sidecar of a file
+    Args:
+        fileName: str: path to the file
+    Returns:
+        dict: feature information, None if there is no sidecar
+    '''
+    # Recording and replaying ask LLM for the feature information every time
+    if LLM_TRANSPORT != "http":
+        return None
+    try:
+        reader = openSidecar(fileName)
+        return None if reader is None else json.loads(reader.schema.metadata[b'feature_info'])
+    except (OSError, pa.ArrowException, KeyError, TypeError, ValueError) as e:
+        print(f"Error reading sidecar: {e}")
+        return None
+
+def loadSidecar(fileName, columns=None):
+    '''
+    Method to load a dataset from its Arrow sidecar instead of parsing the file again
+    Args:
+        fileName: str: path to the file
+        columns: list: columns to be loaded, all columns if not given
+    Returns:
+        DataFrame: typed dataframe, None if there is no sidecar
+        dict: feature information the dataframe was typed with
+    '''
+    try:
+        reader = openSidecar(fileName)
+        if reader is None:
+            return None, None
+        table = reader.read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas(), json.loads(reader.schema.metadata[b'feature_info'])
+    except (OSError, pa.ArrowException, KeyError, TypeError, ValueError) as e:
+        print(f"Error reading sidecar: {e}")
+        return None, None
+
+def writeSidecar(fileName, df, featureInfo):
+    '''
+    Method to write the typed dataset as an uncompressed Arrow IPC file so that later runs can memory-map it
+    Args:
+        fileName: str: path to the file
+        df: DataFrame: typed dataframe
+        featureInfo: dict: feature information the dataframe was typed with
+    '''
+    if CACHE_DISABLED:
+        return
+    path = getSidecarPath(fileName)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'feature_info': json.dumps(featureInfo).encode('utf-8')})
+        with pa.OSFile(tmp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=SIDECAR_BATCH_ROWS)
+        os.replace(tmp_path, path)
+        evictCache(os.path.dirname(path), DATASET_CACHE_MAX_SIZE_MB)
+    except (OSError, pa.ArrowException, TypeError, ValueError) as e:
+        print(f"Error writing sidecar: {e}")
+        removeFile(tmp_path)
+
+def loadDataset(fileName, df, featureInfo):
+    '''
+    Method to get the typed dataset, from the sidecar on later runs, otherwise by typing the parsed file
+    and writing the sidecar
+    Args:
+        fileName: str: path to the file
+        df: DataFrame: dataframe parsed from the file, None if loaded from the sidecar
+        featureInfo: dict: feature information
+    Returns:
+        DataFrame: typed dataframe
+    '''
+    if df is None:
+        df, _ = loadSidecar(fileName)
         return df
+    typed = applyColumnTypes(df, featureInfo)
+    reportMemoryUsage(df, typed)
+    writeSidecar(fileName, typed, featureInfo)
+    return typed
+
+def inferColumnType(values):
+    '''
+    Method to infer the type of a column from a sample of its values
+    Args:
+        values: Series: sample of the column
+    Returns:
+        str: boolean, datetime, integer or float, None if the values are not obviously one of them
+    '''
+    values = values.dropna()
+    if values.empty:
+        return None
+    if pd.api.types.is_bool_dtype(values):
+        return 'boolean'
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return 'datetime'
+    if pd.api.types.is_numeric_dtype(values):
+        return 'integer' if pd.api.types.is_integer_dtype(values) else 'float'
+    text = values.astype(str).str.strip()
+    if text.str.lower().isin(BOOLEAN_VALUES.keys()).all():
+        return 'boolean'
+    # Dates need digits and a separator, plain numbers and words are left to LLM
+    if text.str.contains(r'\d').all() and text.str.contains(r'[-/:]').all():
+        if pd.to_datetime(text, errors='coerce', format='mixed').notna().all():
+            return 'datetime'
+    return None
+
+def getLocalFeatureInfo(df):
+    '''
+    Method to get the feature information of the columns whose type in LOCAL_TYPES is obvious from their values
+    Args:
+        df: DataFrame: dataframe to be analyzed
+    Returns:
+        dict: column -> feature information
+    '''
+    sample = df.head(LOCAL_SAMPLE_ROWS)
+    localInfo = {}
+    for col in df.columns:
+        kind = inferColumnType(sample[col])
+        if kind in LOCAL_TYPES or (kind in ('integer', 'float') and 'numeric' in LOCAL_TYPES):
+            localInfo[col] = {'name': col, 'type': kind, 'description': f"{kind} column, inferred from its values",
+                              'min_value': None, 'stats': kind in ('integer', 'float')}
+    return localInfo
+
+def requestFeatureInfo(df, columns, useCache=True):
+    '''
+    Method to get the feature information of a group of columns from LLM
+    Args:
+        df: DataFrame: dataframe to be analyzed
+        columns: list: columns of the group
+        useCache: bool: set False to bypass the response cache
+    Returns:
+        dict: column -> feature information, for the columns of the group LLM answered
+    '''
+    try:
+        response = handleRequest(METADATA_INSTRUCTION, df[columns][0:7].to_csv(index=False), 'get_column_dtypes', useCache)
+        metadata = json.loads(response['choices'][0]['message']['function_call']['arguments'])['column_metadata']
+        return {item['name']: item for item in metadata if isinstance(item, dict) and item.get('name') in columns}
     except Exception as e:
         print(f"Error: {e}")
+        return {}
 
 def getFeatureInfo(df):
     '''
-    Method to get the feature information such as name, type, description, min_value, statistics could be calculated
+    Method to get the feature information such as name, type, description, min_value, statistics could be calculated.
+    Columns of an obvious type are answered locally, the others are sent to LLM in groups of METADATA_CHUNK_COLUMNS
+    concurrently and the columns missing from the answers are requested again, up to MAX_RETRY times
     Args:
         df: DataFrame: dataframe to be analyzed
     Returns:
         dict: feature information
     '''
-    featureInfo = handleRequest(METADATA_INSTRUCTION, df[0:7].to_csv(index=False), 'get_column_dtypes')
-    return json.loads(featureInfo['choices'][0]['message']['function_call']['arguments'])['column_metadata']
+    localInfo = getLocalFeatureInfo(df)
+    llmInfo = {}
+    pending = [col for col in df.columns if col not in localInfo]
+    # Requests run on a nested pool, outside the stage thread
+    useCache = not getattr(_STAGE, "force", False)
+    for attempt in range(MAX_RETRY):
+        if not pending:
+            break
+        if attempt > 0:
+            print(f"Columns missing from the feature information, requesting again: {pending}")
+        groups = [pending[start:start + METADATA_CHUNK_COLUMNS] for start in range(0, len(pending), METADATA_CHUNK_COLUMNS)]
+        with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as pool:
+            # The cached answer of a group is what left the columns out, ask LLM again
+            futures = [pool.submit(contextvars.copy_context().run, requestFeatureInfo, df, group, useCache and attempt == 0) for group in groups]
+            for future in futures:
+                llmInfo.update(future.result())
+        pending = [col for col in pending if col not in llmInfo]
+
+    if pending:
+        print(f"Error: no feature information from LLM for {pending}, using the types inferred from the values")
+    featureInfo = []
+    for col in df.columns:
+        if col in localInfo or col in llmInfo:
+            featureInfo.append(localInfo.get(col) or llmInfo[col])
+        else:
+            kind = inferColumnType(df[col].head(LOCAL_SAMPLE_ROWS)) or 'string'
+            featureInfo.append({'name': col, 'type': kind, 'description': '', 'min_value': None, 'stats': kind in ('integer', 'float')})
+    return featureInfo
 
-def getMinValue(featureInfo, columnName):
+def getFeatureIndex(featureInfo):
     '''
-    Method to get the minimum value for a column based on the feature information returned by LLM
+    Method to index the feature information returned by LLM by column name
     Args:
         featureInfo: dict: feature information
+    Returns:
+        dict: column name -> feature information
+    '''
+    return {item['name']: item for item in featureInfo}
+
+def getMinValue(featureIndex, columnName):
+    '''
+    Method to get the minimum value for a column based on the feature information returned by LLM
+    Args:
+        featureIndex: dict: feature information indexed by column name
         columnName: str: column name
     Returns:
-        int/float: minimum value for the column
+        int/float: minimum value for the column, None if not available
     '''
-    for item in featureInfo:
-        if item['name'] == columnName:
-            return item['min_value']
-    
+    min_value = featureIndex.get(columnName, {}).get('min_value')
+    return min_value if isinstance(min_value, (int, float)) and not isinstance(min_value, bool) else None
+
+def getStatsColumns(df, featureInfo):
+    '''
+    Method to get the columns flagged for statistics that are numeric in the dataframe
+    Args:
+        df: DataFrame: dataframe to be analyzed
+        featureInfo: dict: feature information
+    Returns:
+        list: list of column names
+    '''
+    return [feature['name'] for feature in featureInfo
+            if feature['stats'] and feature['name'] in df.columns and pd.api.types.is_numeric_dtype(df[feature['name']])
+            and not pd.api.types.is_bool_dtype(df[feature['name']])]
+
 def getDescriptiveStats(df, featureInfo):
     '''
     Method to get the descriptive statistics for the dataframe
@@ -431,54 +1352,117 @@ def getDescriptiveStats(df, featureInfo):
     Returns:
         dict: descriptive statistics
     '''
-    nullValues = df.isnull().sum().to_dict()
-    columnForStats = [feature['name'] for feature in featureInfo if feature['stats']]
-    descriptiveStats = df[columnForStats].describe().to_dict()
-    for key, stats in descriptiveStats.items():
-        if key in nullValues:
-            stats['null'] = nullValues[key]
-            stats['invalid'] = df[df[key] < getMinValue(featureInfo, key)].shape[0]
-    return descriptiveStats
-
-def dataPreprocessing(df, featureInfo, statsInfo):
+    featureIndex = getFeatureIndex(featureInfo)
+    columnForStats = getStatsColumns(df, featureInfo)
+    matrix = df[columnForStats].to_numpy(dtype=np.float64, na_value=np.nan)
+    minValues = np.array([getMinValue(featureIndex, col) for col in columnForStats], dtype=np.float64)
+    profile = profileMatrix(matrix, minValues)
+    return {col: {stat: profile[stat][idx].item() for stat in profile} for idx, col in enumerate(columnForStats)}
+
+def columnQuantiles(matrix, quantiles):
+    '''
+    Method to get quantiles of every column of a float matrix from a single sort, NaN are ignored
+    Args:
+        matrix: ndarray: rows x columns float matrix
+        quantiles: list: quantiles between 0 and 1
+    Returns:
+        ndarray: quantiles x columns, NaN for columns without values
     '''
-    Method to preprocess the data, impute missing values and remove invalid values for numerical features and remove rows with missing values
+    # NaN are sorted to the end of each column
+    ordered = np.sort(matrix, axis=0)
+    count = matrix.shape[0] - np.isnan(matrix).sum(axis=0)
+    result = np.full((len(quantiles), matrix.shape[1]), np.nan)
+    if len(ordered) == 0:
+        return result
+    last = np.maximum(count - 1, 0)
+    for idx, q in enumerate(quantiles):
+        # Linear interpolation between the closest ranks, as DataFrame.describe does
+        position = q * last
+        lower = np.floor(position).astype(np.intp)
+        upper = np.ceil(position).astype(np.intp)
+        lowerValue = np.take_along_axis(ordered, lower[np.newaxis, :], axis=0)[0]
+        upperValue = np.take_along_axis(ordered, upper[np.newaxis, :], axis=0)[0]
+        result[idx] = np.where(count > 0, lowerValue + (upperValue - lowerValue) * (position - lower), np.nan)
+    return result
+
+def profileMatrix(matrix, minValues):
+    '''
+    Method to profile all columns of a float matrix at once, NaN are treated as missing values
+    Args:
+        matrix: ndarray: rows x columns float matrix
+        minValues: ndarray: minimum valid value per column, NaN if not available
+    Returns:
+        dict: statistic name -> array with one value per column, with the keys of DataFrame.describe
+            plus null and invalid (count of values below the minimum)
+    '''
+    missing = np.isnan(matrix)
+    count = matrix.shape[0] - missing.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(missing, 0, matrix).sum(axis=0) / count
+        deviation = np.where(missing, 0, matrix - mean)
+        std = np.where(count > 1, np.sqrt((deviation ** 2).sum(axis=0) / (count - 1)), np.nan)
+        invalid = (matrix < minValues).sum(axis=0)
+
+    profile = {"count": count.astype(np.float64), "mean": mean, "std": std}
+    quantiles = columnQuantiles(matrix, [0.0, 0.25, 0.5, 0.75, 1.0])
+    for idx, name in enumerate(["min", "25%", "50%", "75%", "max"]):
+        profile[name] = quantiles[idx]
+    profile["null"] = missing.sum(axis=0)
+    profile["invalid"] = invalid
+    return profile
+
+def dataPreprocessing(df, featureInfo, statsInfo, means=None):
+    '''
+    Method to preprocess the data, impute missing values and remove invalid values for numerical features and remove rows with missing values.
+    Dtypes and index of the input are preserved
     Args:
         df: DataFrame: dataframe to be analyzed
         featureInfo: dict: feature information
         statsInfo: dict: descriptive statistics
+        means: dict: column -> mean used for imputation, computed from df if not given
     Returns:
         DataFrame: preprocessed dataframe
+        dict: count of dropped rows and of out of range values per column
     '''
-    # Initialize counters
-    dropped_rows = 0
     below_range_values = {col: 0 for col in statsInfo.keys()}
+    featureIndex = getFeatureIndex(featureInfo)
+    # Shallow copy, columns are replaced below without touching the caller's dataframe
+    df_processed = df.copy(deep=False)
+    original_dtypes = df.dtypes
+
+    for col in statsInfo.keys():
+        values = df_processed[col]
+        if not pd.api.types.is_numeric_dtype(values):
+            values = pd.to_numeric(values, errors='coerce')
+        mean = values.mean() if means is None else means[col]
+        if pd.isna(mean):
+            # Nothing to impute from, drop the column instead of dropping every row
+            df_processed = df_processed.drop(columns=col)
+            continue
+
+        # Impute missing numeric values with mean
+        values = values.fillna(mean)
+
+        # Set values below the minimum to NaN, tracking how many were masked
+        min_value = getMinValue(featureIndex, col)
+        if min_value is not None:
+            below_range = values < min_value
+            below_range_values[col] = int(below_range.sum())
+            values = values.mask(below_range)
+        df_processed[col] = values
 
-    # Impute missing numeric values with mean
-    imputer = SimpleImputer(missing_values=np.nan, strategy='mean')
-    transformer = ColumnTransformer([('impute', imputer, list(statsInfo.keys()))],
-                                    remainder='passthrough', verbose_feature_names_out=False)
-    df_imputed = transformer.fit_transform(df)
-    df_imputed = pd.DataFrame(df_imputed, columns=transformer.get_feature_names_out())
-
-    # Loop through columns and check for values below the minimum
-    for col in df_imputed.columns:
-        if col in statsInfo.keys():
-            min_value = getMinValue(featureInfo, col)
-            below_range = df_imputed[col] < min_value
-            below_range_count = below_range.sum()  # Count of values below the minimum
-
-            # Track how many values are below the minimum
-            below_range_values[col] = below_range_count
+    # Drop rows with any NaN values
+    missing_rows = df_processed.isna().any(axis=1)
+    dropped_rows = int(missing_rows.sum())
+    df_processed = df_processed[~missing_rows]
 
-            # Set values below the range to NaN
-            df_imputed.loc[below_range, col] = np.nan
+    # Masking turns integer columns into float, restore them once the NaN rows are gone
+    for col in df_processed.columns:
+        if pd.api.types.is_integer_dtype(original_dtypes[col]) and not pd.api.types.is_integer_dtype(df_processed[col]):
+            df_processed[col] = df_processed[col].astype(original_dtypes[col])
 
-    # Drop rows with any NaN values
-    dropped_rows = df_imputed.isna().sum(axis=1).sum()  # Count total NaN values (which will be dropped)
-    df_imputed.dropna(inplace=True)
     update_details = {"dropped_rows": dropped_rows, "out_of_range_values": below_range_values}
-    return df_imputed, update_details
+    return df_processed, update_details
 
 def getSummaryAndNextSteps(df,statsInfo):
     '''
@@ -489,23 +1473,49 @@ def getSummaryAndNextSteps(df,statsInfo):
     Returns:
         dict: summary and next steps
     '''
-    content = f"Columns:{df.columns}\n\nData Types:{df.dtypes}\n\nStatistics: {statsInfo}"
+    content = buildPrompt('get_intro_stats_summary', [("Columns", getColumnTypes(df)), ("Statistics", statsInfo)])
     response = handleRequest(INTRO_AND_DESCRIPTIVE_STATS_INSTRUCTION, content, 'get_intro_stats_summary')
-    print(response)
     arguments = json.loads(response['choices'][0]['message']['function_call']['arguments'])
     return arguments
 
-def executeRequest(instruction, content, functionName,df):
+def getCodeCacheKey(df, analysisType):
+    '''
+    Method to get the cache key of generated code from the column names and dtypes and the analysis type
+    Args:
+        df: DataFrame: dataframe to be analyzed
+        analysisType: str: time_series, geospatial or network
+    Returns:
+        str: cache key
+    '''
+    return getCacheKey({"analysis": analysisType, "schema": [[column, str(dtype)] for column, dtype in df.dtypes.items()]})
+
+def executeRequest(instruction, content, functionName, df, analysisType):
     '''
-    Method to handle the request and execute the code returned by LLM
+    Method to handle the request and execute the code returned by LLM, code that ran successfully is
+    cached and re-executed first on data with the same columns and dtypes
     Args:
         instruction: str: instruction to be passed to LLM
         content: str: content to be passed to LLM
         functionName: str: name of the function to be called
         df: DataFrame: dataframe to be analyzed
+        analysisType: str: time_series, geospatial or network
     Returns:
         str: title, output file, rationale
     '''
+    # The dataframe is written once and memory-mapped by every attempt
+    dataPath = writeCodeData(df)
+    codeKey = getCodeCacheKey(df, analysisType)
+    # Forced stages regenerate the code, recording and replaying go through the transport for every call
+    useCodeCache = not CACHE_DISABLED and not getattr(_STAGE, "force", False) and LLM_TRANSPORT == "http"
+    cached = readCache(codeKey) if useCodeCache else None
+    if cached:
+        error = runCodeSandboxed(cached['python_code'], dataPath, cached['output_file'])
+        if not error:
+            print(f"Cached {analysisType} code executed successfully")
+            removeFile(dataPath)
+            return cached['title'], cached['output_file'], cached['rationale']
+        print(f"Error: cached {analysisType} code failed, asking LLM: {error}")
+
     response = handleRequest(instruction, content, functionName)
     codeBlock = ""
     error = ""
@@ -522,9 +1532,15 @@ def executeRequest(instruction, content, functionName,df):
             output_file = json.loads(response['choices'][0]['message']['function_call']['arguments'])['output_file']
             rationale = json.loads(response['choices'][0]['message']['function_call']['arguments'])['rationale']            
             title = json.loads(response['choices'][0]['message']['function_call']['arguments'])['title']
-            # Execute the code block
-            exec(codeBlock)
+            # Execute the code block in a child process, a failure is retried like an exception
+            error = runCodeSandboxed(codeBlock, dataPath, output_file)
+            if error:
+                print(f"Error: {error}")
+                continue
             flag = False
+            if not CACHE_DISABLED:
+                writeCache(codeKey, {"python_code": codeBlock, "output_file": output_file, "title": title, "rationale": rationale})
+            removeFile(dataPath)
             return title, output_file, rationale
         except Exception as e:
             # Print the error and retry
@@ -536,129 +1552,554 @@ def executeRequest(instruction, content, functionName,df):
         finally:
             attempt += 1
 
+    removeFile(dataPath)
     return ""
 
-def advancedAnalytics(df, statsInfo, summaryInfo):
+def writeCodeData(df):
     '''
-    Method to perform analysis on the dataframe
+    Method to write the dataframe to a temporary Arrow file for the generated code
     Args:
         df: DataFrame: dataframe to be analyzed
-        statsInfo: dict: descriptive statistics
-        summaryInfo: dict: summary and next steps
     Returns:
-        list: analysis output
+        str: path of the Arrow file
+    '''
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # Object columns mixing numbers and strings, as read_csv leaves them, are passed as strings
+        df = df.copy(deep=False)
+        for col in df.columns:
+            if pd.api.types.is_object_dtype(df[col]) or isinstance(df[col].dtype, pd.CategoricalDtype):
+                try:
+                    pa.array(df[col], from_pandas=True)
+                except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                    df[col] = df[col].astype('string')
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    fd, path = tempfile.mkstemp(suffix=".arrow")
+    os.close(fd)
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return path
+
+def getProcessMemory(pid):
+    '''
+    Method to get the address space and resident memory of a process
+    Args:
+        pid: int: process id
+    Returns:
+        tuple: address space and resident memory in MB, 0 where /proc is not available
     '''
-    content = f"Columns:{df.columns}\n\nData Types:{df.dtypes}\n\nStatistics: {statsInfo}"
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            size, resident = f.read().split()[:2]
+        return int(size) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), int(resident) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return 0, 0
 
-    analysis_output = []
-    if summaryInfo["time_series"]["isavailable"]:
-        try:
-            prompt = GENERIC_CODE_INSTRUCTION + ADVANCED_ANALYSIS_INSTRUCTION + summaryInfo['time_series']['prompt']
-            title, output_file, rationale = executeRequest(prompt,content,"get_code_for_analysis",df)
-            analysis_output.append({"title":title, "output_file":output_file, "rationale":rationale})
+def getProcessRss(pid):
+    '''
+    Method to get the resident memory of a process
+    Args:
+        pid: int: process id
+    Returns:
+        float: resident memory in MB, 0 where /proc is not available
+    '''
+    return getProcessMemory(pid)[1]
+
+def runCode(codeBlock, dataPath, workDir, conn):
+    '''
+    Method run in the child process to execute the generated code on the memory-mapped dataframe
+    Args:
+        codeBlock: str: generated code
+        dataPath: str: Arrow file holding the dataframe
+        workDir: str: directory the output file is written to
+        conn: Connection: pipe receiving the traceback, empty on success
+    '''
+    try:
+        os.chdir(workDir)
+        # Columns without nulls are used straight from the mapped file
+        df = pa.ipc.open_file(pa.memory_map(dataPath, 'r')).read_all().to_pandas(split_blocks=True)
+        modules = {alias: importModule(name) for alias, name in CODE_MODULES.items() if alias in codeBlock}
+        if importlib.util.find_spec("resource") is not None:
+            # The CPU limit counts from here, not from the start of the process
+            resource = importModule("resource")
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            limit = int(usage.ru_utime + usage.ru_stime) + CODE_CPU_SECONDS
+            resource.setrlimit(resource.RLIMIT_CPU, (limit, limit + 5))
+            # Allocations beyond CODE_MAX_RSS_MB more memory fail in the kernel, even between two polls of the parent
+            size = getProcessMemory(os.getpid())[0]
+            if size:
+                memoryLimit, kind = int((size + CODE_MAX_RSS_MB) * 1024 * 1024), resource.RLIMIT_AS
+            else:
+                # Without /proc the peak resident memory (kilobytes, bytes on macOS) bounds the data segment instead
+                peak = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+                memoryLimit, kind = int((peak + CODE_MAX_RSS_MB) * 1024 * 1024), resource.RLIMIT_DATA
+            try:
+                resource.setrlimit(kind, (memoryLimit, memoryLimit))
+            except (ValueError, OSError) as e:
+                print(f"Error setting the memory limit: {e}")
+        exec(codeBlock, {**globals(), **modules, "__name__": "__generated__", "df": df})
+        conn.send("")
+    except BaseException:
+        conn.send(traceback.format_exc())
+    finally:
+        conn.close()
+
+def runCodeSandboxed(codeBlock, dataPath, output_file):
+    '''
+    Method to execute generated code in a child process bounded by CODE_TIMEOUT seconds of wall time,
+    CODE_CPU_SECONDS of CPU time and CODE_MAX_RSS_MB of memory, enforced by resource limits in the child
+    and by polling its resident memory where /proc is available
+    Args:
+        codeBlock: str: generated code
+        dataPath: str: Arrow file holding the dataframe
+        output_file: str: file the code is expected to write
+    Returns:
+        str: traceback or reason the code failed, empty on success
+    '''
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=runCode, args=(codeBlock, dataPath, os.path.abspath(_OUTPUT_DIR.get()), sender), daemon=True)
+    process.start()
+    sender.close()
+    error = None
+    deadline = time.monotonic() + CODE_TIMEOUT
+    try:
+        with traceSpan("generated code", "compute") as event:
+            event["child_peak_rss_mb"] = 0
+            while error is None:
+                rss = getProcessRss(process.pid)
+                event["child_peak_rss_mb"] = max(event["child_peak_rss_mb"], rss)
+                if receiver.poll(0.1):
+                    error = receiver.recv()
+                elif time.monotonic() > deadline:
+                    error = f"Code did not finish within {CODE_TIMEOUT}s"
+                elif rss > CODE_MAX_RSS_MB:
+                    error = f"Code exceeded the memory limit of {CODE_MAX_RSS_MB} MB"
+    except EOFError:
+        # The pipe closes without a message when the process dies, by SIGXCPU once the CPU limit is reached
+        process.join()
+        code = process.exitcode
+        if code is not None and code == -getattr(signal, "SIGXCPU", 0):
+            error = f"Code exceeded the CPU time limit of {CODE_CPU_SECONDS}s"
+        elif code is not None and code < 0:
+            name = signal.Signals(-code).name if -code in signal.valid_signals() else str(-code)
+            error = f"Code process was killed by signal {name}"
+        else:
+            error = f"Code process exited with code {code}"
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        receiver.close()
+    if not error and not os.path.exists(getOutputPath(output_file)):
+        error = f"Code finished without writing {output_file}"
+    return error
+
+def advancedAnalytics(df, statsInfo, summaryInfo):
+    '''
+    Method to perform analysis on the dataframe
+    Args:
+        df: DataFrame: dataframe to be analyzed
+        statsInfo: dict: descriptive statistics
+        summaryInfo: dict: summary and next steps
+    Returns:
+        list: analysis output
+    '''
+    content = buildPrompt('get_code_for_analysis', [("Columns", getColumnTypes(df)), ("Statistics", statsInfo)])
+
+    analysis_output = []
+    if summaryInfo["time_series"]["isavailable"]:
+        try:
+            prompt = GENERIC_CODE_INSTRUCTION + ADVANCED_ANALYSIS_INSTRUCTION + summaryInfo['time_series']['prompt']
+            title, output_file, rationale = executeRequest(prompt,content,"get_code_for_analysis",df,"time_series")
+            analysis_output.append({"title":title, "output_file":output_file, "rationale":rationale})
         except Exception as e:
             print(f"Error: {e}")
     elif summaryInfo["geospatial"]["isavailable"]:
         try:
             prompt = GENERIC_CODE_INSTRUCTION  + ADVANCED_ANALYSIS_INSTRUCTION + summaryInfo['geospatial']['prompt']
-            title, output_file, rationale = executeRequest(prompt,content,"get_code_for_analysis",df)
+            title, output_file, rationale = executeRequest(prompt,content,"get_code_for_analysis",df,"geospatial")
             analysis_output.append({"title":title, "output_file":output_file, "rationale":rationale})
         except Exception as e:
             print(f"Error: {e}")
     elif summaryInfo["network"]["isavailable"]:
         try:
             prompt = GENERIC_CODE_INSTRUCTION  + ADVANCED_ANALYSIS_INSTRUCTION + summaryInfo['network']['prompt']
-            title, output_file, rationale = executeRequest(prompt,content,"get_code_for_analysis",df)
+            title, output_file, rationale = executeRequest(prompt,content,"get_code_for_analysis",df,"network")
             analysis_output.append({"title":title, "output_file":output_file, "rationale":rationale})
         except Exception as e:
             print(f"Error: {e}")
     return analysis_output
 
-def applyKMeansClustering(df, featureInfo, n_clusters=5):
+def fitClusterModel(data, n_clusters):
+    '''
+    Method to fit the clustering model, full batch KMeans up to CLUSTER_SAMPLE_ROWS rows and MiniBatchKMeans above
+    Args:
+        data: ndarray: standardized rows to fit on
+        n_clusters: int: number of clusters
+    Returns:
+        model: fitted KMeans or MiniBatchKMeans
+    '''
+    if len(data) <= CLUSTER_SAMPLE_ROWS:
+        return importModule("sklearn.cluster").KMeans(n_clusters=n_clusters, random_state=42).fit(data)
+    return importModule("sklearn.cluster").MiniBatchKMeans(n_clusters=n_clusters, random_state=42, batch_size=4096, n_init=3).fit(data)
+
+def selectClusterCount(data):
     '''
-    Apply KMeans clustering on the data and plot the clusters.
+    Method to choose the number of clusters by fitting every k between CLUSTER_K_MIN and CLUSTER_K_MAX in
+    parallel and keeping the k with the best silhouette score, computed on a sample of rows
+    Args:
+        data: ndarray: standardized rows to fit on
+    Returns:
+        model: fitted model of the chosen k
+        list: k, silhouette score and seconds taken for each candidate
+    '''
+    # Silhouette needs at least two clusters and fewer clusters than rows
+    candidates = range(max(CLUSTER_K_MIN, 2), min(CLUSTER_K_MAX, len(data) - 1) + 1)
+    workers = max(1, min(CPU_WORKERS, len(candidates)))
+    # Each candidate gets its share of the cores, so that the seconds reported are not contention between fits
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    # Candidates run on a nested pool, outside the context of the dataset
+    dataset = _DATASET.get()
+    def evaluate(k):
+        start = time.perf_counter()
+        with traceSpan(f"kmeans k={k}", "compute", dataset=dataset, rows=data.shape[0], columns=data.shape[1], threads=threads), \
+             importModule("threadpoolctl").threadpool_limits(limits=threads):
+            model = fitClusterModel(data, k)
+            score = importModule("sklearn.metrics").silhouette_score(data, model.labels_, sample_size=min(SILHOUETTE_SAMPLE_ROWS, len(data)), random_state=42)
+        return model, {"k": k, "silhouette": float(score), "seconds": round(time.perf_counter() - start, 3)}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(evaluate, candidates))
+    for _, result in results:
+        print(f"k={result['k']}: silhouette {result['silhouette']:.3f} in {result['seconds']}s")
+    model, _ = max(results, key=lambda item: item[1]["silhouette"])
+    return model, [result for _, result in results]
+
+def applyKMeansClustering(df, featureInfo, n_clusters=None):
+    '''
+    Apply KMeans clustering on the standardized data and plot the clusters. On large data the number of clusters
+    is chosen with KMeans on a sample of CLUSTER_SAMPLE_ROWS rows, MiniBatchKMeans is then fitted on all rows
+    and the rows are assigned in chunks
     Args:
         df: DataFrame: input data to be clustered
         featureInfo: dict: feature information
-        n_clusters: int: number of clusters for KMeans
+        n_clusters: int: number of clusters for KMeans, chosen by silhouette score if not given
     Returns:
         dict: clusters information
     '''
-    numerical_columns = [feature['name'] for feature in featureInfo if feature['stats']]
-    df[numerical_columns] = df[numerical_columns].apply(pd.to_numeric, errors='coerce')
-
+    numerical_columns = getStatsColumns(df, featureInfo)
     print(numerical_columns)
+    # Imported here so the time is reported against this stage, candidates are fitted on a nested pool
+    importModule("sklearn.cluster")
+    importModule("sklearn.metrics")
+    data = importModule("sklearn.preprocessing").StandardScaler().fit_transform(df[numerical_columns].to_numpy(dtype=np.float32))
 
-    # Apply KMeans clustering
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    df['Cluster'] = kmeans.fit_predict(df[numerical_columns])
+    sample = data
+    if len(data) > CLUSTER_SAMPLE_ROWS:
+        sample = data[np.random.default_rng(42).choice(len(data), CLUSTER_SAMPLE_ROWS, replace=False)]
 
-    # Reduce dimensions to 2D using PCA for better visualization
-    pca = PCA(n_components=2)
-    pca_components = pca.fit_transform(df[numerical_columns]) # Exclude 'Cluster' from PCA
+    # Apply KMeans clustering
+    selection = []
+    if n_clusters is None and len(sample) > 2:
+        kmeans, selection = selectClusterCount(sample)
+        n_clusters = kmeans.n_clusters
+    # The model chosen on the sample is kept unless there are more rows than the sample
+    if not selection or len(data) > CLUSTER_SAMPLE_ROWS:
+        n_clusters = min(n_clusters or 1, len(sample))
+        with traceSpan(f"kmeans fit k={n_clusters}", "compute", rows=data.shape[0], columns=data.shape[1]):
+            kmeans = fitClusterModel(data, n_clusters)
+    labels = np.concatenate([kmeans.predict(data[start:start + CLUSTER_CHUNK_ROWS])
+                             for start in range(0, len(data), CLUSTER_CHUNK_ROWS)])
+    labels = pd.Series(labels, name='Cluster')
+
+    # Reduce dimensions to 2D using PCA for better visualization, large data is projected with a
+    # randomized PCA fitted on the sample
+    if len(data) > CLUSTER_SAMPLE_ROWS:
+        pca = importModule("sklearn.decomposition").PCA(n_components=2, svd_solver='randomized', random_state=42).fit(sample)
+        pca_components = np.concatenate([pca.transform(data[start:start + CLUSTER_CHUNK_ROWS])
+                                         for start in range(0, len(data), CLUSTER_CHUNK_ROWS)])
+    else:
+        pca_components = importModule("sklearn.decomposition").PCA(n_components=2).fit_transform(data)
     print(pca_components.shape)
 
-    # Create a new DataFrame for plotting
-    df_pca = pd.DataFrame(pca_components, columns=['PC1', 'PC2'])
-    df_pca['Cluster'] = df['Cluster']
-
     # Generate and save the cluster visualization chart
-    output_file = "clusters.png"
-    plt.figure(figsize=(10, 6))
-    sns.scatterplot(data=df_pca, x='PC1', y='PC2', hue='Cluster', palette="viridis", s=100, marker='o', edgecolor='k', alpha=0.7)
-    plt.title('KMeans Clustering (2D PCA Projection)', fontsize=16)
-    plt.xlabel('PC1')
-    plt.ylabel('PC2')
-    plt.legend(title='Cluster')
-    plt.tight_layout()
-    plt.savefig(output_file)
-    plt.close()
-
-    clusters = df['Cluster'].value_counts().to_dict()
-    clusterInfo = {"clusters":clusters, "output_file":output_file}
+    output_file = plotClusters(pca_components, labels.to_numpy(), "clusters.png")
+
+    clusters = labels.value_counts().to_dict()
+    clusterInfo = {"clusters":clusters, "output_file":output_file, "k_selection":selection}
     return clusterInfo
 
-def getHighCorrelation(df, featureInfo, threshold=0.8):
+_CHART_POOL = None
+_CHART_POOL_LOCK = threading.Lock()
+
+def getChartPool():
+    '''
+    Method to get the process pool rendering the charts, created on first use
+    Returns:
+        ProcessPoolExecutor: pool of CHART_WORKERS processes, None to render in this process
+    '''
+    global _CHART_POOL
+    with _CHART_POOL_LOCK:
+        if _CHART_POOL is None and CHART_WORKERS > 0:
+            # Spawned workers do not inherit the locks held by the pipeline threads
+            _CHART_POOL = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _CHART_POOL
+
+def submitChart(renderer, spec):
+    '''
+    Method to render a chart in the background while the pipeline continues
+    Args:
+        renderer: function: module level function drawing the chart from the spec
+        spec: dict: output file and the data the chart needs
+    Returns:
+        Future: output file, once rendered
+    '''
+    # Workers may not share the working directory of this process
+    spec = {**spec, "path": os.path.abspath(getOutputPath(spec["output_file"]))}
+    pool = getChartPool()
+    event = {"name": f"chart {spec['output_file']}", "category": "chart", "dataset": _DATASET.get(), "thread": "charts"}
+    start = time.perf_counter()
+    if pool is not None:
+        future = pool.submit(renderer, spec)
+    else:
+        future = Future()
+        try:
+            future.set_result(renderer(spec))
+        except Exception as e:
+            future.set_exception(e)
+    # Stage fingerprints use the file name without waiting for the chart
+    future.output_file = spec["output_file"]
+    # Rendered in another process, only the time from submission to the saved file is known
+    future.add_done_callback(lambda done: addTraceEvent({**event, "start": round(start - IMPORT_START, 6), "wall": round(time.perf_counter() - start, 6)}))
+    return future
+
+def saveChart(fig, spec):
+    '''
+    Method to save a rendered chart
+    Args:
+        fig: Figure: chart figure
+        spec: dict: chart spec with output file and path
+    Returns:
+        str: output file
+    '''
+    fig.tight_layout()
+    fig.savefig(spec["path"])
+    return spec["output_file"]
+
+def getChartFile(output_file):
+    '''
+    Method to wait for a chart rendered in the background
+    Args:
+        output_file: Future or str: output file of the chart
+    Returns:
+        str: output file
+    '''
+    if not isinstance(output_file, Future):
+        return output_file
+    try:
+        return output_file.result()
+    except Exception as e:
+        print(f"Error rendering chart: {e}")
+        return ""
+
+def plotClusters(pca_components, labels, output_file):
+    '''
+    Method to plot the clusters on the first two principal components, as a scatter plot up to
+    SCATTER_MAX_ROWS rows and as density shading coloured by the dominant cluster of each bin above
+    Args:
+        pca_components: ndarray: rows x 2 projection
+        labels: ndarray: cluster of each row
+        output_file: str: path of the chart
+    Returns:
+        Future: output file, once rendered
+    '''
+    clusters = np.unique(labels)
+    spec = {"output_file": output_file, "clusters": clusters}
+    if len(labels) <= SCATTER_MAX_ROWS:
+        spec["points"] = pd.DataFrame({'PC1': pca_components[:, 0], 'PC2': pca_components[:, 1], 'Cluster': labels})
+    else:
+        # Count rows per (cluster, x bin, y bin) in one pass, only the counts are sent to the renderer
+        x, y = pca_components[:, 0], pca_components[:, 1]
+        xEdges = np.linspace(x.min(), x.max(), DENSITY_BINS + 1)
+        yEdges = np.linspace(y.min(), y.max(), DENSITY_BINS + 1)
+        xBin = np.clip(np.searchsorted(xEdges, x, side='right') - 1, 0, DENSITY_BINS - 1)
+        yBin = np.clip(np.searchsorted(yEdges, y, side='right') - 1, 0, DENSITY_BINS - 1)
+        clusterIdx = np.searchsorted(clusters, labels)
+        spec["counts"] = np.bincount((clusterIdx * DENSITY_BINS + yBin) * DENSITY_BINS + xBin,
+                                     minlength=len(clusters) * DENSITY_BINS * DENSITY_BINS).reshape(len(clusters), DENSITY_BINS, DENSITY_BINS)
+        spec["extent"] = (xEdges[0], xEdges[-1], yEdges[0], yEdges[-1])
+    return submitChart(renderClusters, spec)
+
+def renderClusters(spec):
+    '''
+    Method to render the cluster chart of plotClusters
+    Args:
+        spec: dict: output file, clusters and either the points or the density counts and extent
+    Returns:
+        str: output file
+    '''
+    sns = importModule("seaborn")
+    fig = importModule("matplotlib.figure").Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    palette = sns.color_palette("viridis", len(spec["clusters"]))
+    if "points" in spec:
+        sns.scatterplot(data=spec["points"], x='PC1', y='PC2', hue='Cluster', palette="viridis", s=100, marker='o', edgecolor='k', alpha=0.7, ax=ax)
+        ax.legend(title='Cluster')
+    else:
+        counts = spec["counts"]
+        total = counts.sum(axis=0)
+        image = np.zeros(total.shape + (4,))
+        image[..., :3] = np.array(palette)[counts.argmax(axis=0)]
+        image[..., 3] = np.where(total > 0, 0.25 + 0.75 * np.log1p(total) / np.log1p(total.max()), 0)
+        ax.imshow(image, origin='lower', aspect='auto', interpolation='nearest', extent=spec["extent"])
+        handles = [importModule("matplotlib.patches").Patch(color=palette[idx], label=str(cluster)) for idx, cluster in enumerate(spec["clusters"])]
+        ax.legend(handles=handles, title='Cluster (density)')
+    ax.set_title('KMeans Clustering (2D PCA Projection)', fontsize=16)
+    ax.set_xlabel('PC1')
+    ax.set_ylabel('PC2')
+    return saveChart(fig, spec)
+
+def standardizeColumns(data, method):
+    '''
+    Method to scale the columns so that the correlation matrix is the product of the matrix with itself
+    Args:
+        data: DataFrame: numerical columns without NaN
+        method: str: pearson or spearman, spearman correlates the ranks of the values
+    Returns:
+        ndarray: float32 rows x columns matrix, constant columns are all zero
+    '''
+    if method == 'spearman':
+        data = data.rank()
+    matrix = data.to_numpy(dtype=np.float64)
+    matrix = matrix - matrix.mean(axis=0)
+    norm = np.sqrt((matrix ** 2).sum(axis=0))
+    return (matrix / np.where(norm > 0, norm, 1)).astype(np.float32)
+
+def iterCorrelationBlocks(standardized, blockSize=CORRELATION_BLOCK_COLUMNS):
+    '''
+    Method to compute the upper triangle of the correlation matrix block by block
+    Args:
+        standardized: ndarray: matrix from standardizeColumns
+        blockSize: int: number of columns per block
+    Returns:
+        iterator: (first row column, first column, block of correlations)
+    '''
+    size = standardized.shape[1]
+    for rowStart in range(0, size, blockSize):
+        rows = standardized[:, rowStart:rowStart + blockSize]
+        for colStart in range(rowStart, size, blockSize):
+            yield rowStart, colStart, rows.T @ standardized[:, colStart:colStart + blockSize]
+
+def extractCorrelationPairs(blocks, columns, threshold, topK):
+    '''
+    Method to get the strongest correlated pairs above the threshold without building the stacked matrix
+    Args:
+        blocks: iterator: blocks from iterCorrelationBlocks, or a single block of the full matrix
+        columns: list: column names
+        threshold: float: absolute correlation threshold
+        topK: int: maximum number of pairs to keep
+    Returns:
+        DataFrame: Feature1, Feature2 and Correlation of the strongest pairs
+        ndarray: strongest absolute correlation of each column with any other column
+    '''
+    strongest = np.zeros(len(columns))
+    first, second, values = [], [], []
+    for rowStart, colStart, block in blocks:
+        rowIdx = np.arange(rowStart, rowStart + block.shape[0])[:, np.newaxis]
+        colIdx = np.arange(colStart, colStart + block.shape[1])[np.newaxis, :]
+        # Only pairs above the diagonal, each pair once
+        strength = np.where(colIdx > rowIdx, np.abs(np.nan_to_num(block)), 0)
+        np.maximum.at(strongest, rowIdx[:, 0], strength.max(axis=1))
+        np.maximum.at(strongest, colIdx[0], strength.max(axis=0))
+        rows, cols = np.nonzero(strength > threshold)
+        first.append(rows + rowStart)
+        second.append(cols + colStart)
+        values.append(block[rows, cols].astype(np.float64))
+    first, second, values = (np.concatenate(items) if items else np.empty(0) for items in (first, second, values))
+    order = np.argsort(-np.abs(values), kind='stable')[:topK]
+    names = np.array(columns, dtype=object)
+    pairs = pd.DataFrame({'Feature1': names[first[order].astype(int)], 'Feature2': names[second[order].astype(int)],
+                          'Correlation': values[order].round(3)})
+    return pairs, strongest
+
+def getHeatmapOrder(corr_matrix):
+    '''
+    Method to order the heatmap columns so that correlated columns sit next to each other
+    Args:
+        corr_matrix: DataFrame: correlation matrix
+    Returns:
+        list: ordered column names
+    '''
+    if len(corr_matrix) < 3:
+        return list(corr_matrix.columns)
+    distance = 1 - np.abs(np.nan_to_num(corr_matrix.to_numpy(dtype=np.float64)))
+    np.fill_diagonal(distance, 0)
+    hierarchy = importModule("scipy.cluster.hierarchy")
+    condensed = importModule("scipy.spatial.distance").squareform(np.clip(distance, 0, None), checks=False)
+    order = hierarchy.leaves_list(hierarchy.linkage(condensed, method='average'))
+    return [corr_matrix.columns[idx] for idx in order]
+
+def getHighCorrelation(df, featureInfo, threshold=0.8, corr_matrix=None, method=CORRELATION_METHOD):
     '''
     Generate a correlation heatmap for the numerical columns in the dataframe
     and return significant correlations greater than a defined threshold.
+    Correlations are computed in column blocks and only the CORRELATION_TOP_K strongest pairs are kept,
+    the heatmap shows the HEATMAP_MAX_COLUMNS most correlated columns ordered by hierarchical clustering.
     
     Args:
         df: DataFrame: Input dataframe with numerical columns
         threshold: float: Correlation threshold to consider for significance
+        corr_matrix: DataFrame: precomputed correlation matrix, computed from df if not given
+        method: str: pearson or spearman
     
     Returns:
         significant_corr: DataFrame: A DataFrame with significant correlations
     '''
-    numerical_columns = [feature['name'] for feature in featureInfo if feature['stats']]
-    df[numerical_columns] = df[numerical_columns].apply(pd.to_numeric, errors='coerce')
-    # Compute the correlation matrix
-    corr_matrix = df[numerical_columns].corr()
+    if corr_matrix is None:
+        numerical_columns = getStatsColumns(df, featureInfo)
+        standardized = standardizeColumns(df[numerical_columns], method)
+        high_corr_matrix, strongest = extractCorrelationPairs(iterCorrelationBlocks(standardized), numerical_columns, threshold, CORRELATION_TOP_K)
+        selected = np.sort(np.argsort(-strongest, kind='stable')[:HEATMAP_MAX_COLUMNS])
+        subset = standardized[:, selected]
+        heatmap_matrix = pd.DataFrame(subset.T @ subset, index=[numerical_columns[idx] for idx in selected],
+                                      columns=[numerical_columns[idx] for idx in selected])
+    else:
+        numerical_columns = list(corr_matrix.columns)
+        high_corr_matrix, strongest = extractCorrelationPairs([(0, 0, corr_matrix.to_numpy())], numerical_columns, threshold, CORRELATION_TOP_K)
+        selected = np.sort(np.argsort(-strongest, kind='stable')[:HEATMAP_MAX_COLUMNS])
+        heatmap_matrix = corr_matrix.iloc[selected, selected]
+    heatmap_order = getHeatmapOrder(heatmap_matrix)
+    heatmap_matrix = heatmap_matrix.loc[heatmap_order, heatmap_order]
 
-    output_file = "correlation_heatmap.png"
     # Generate the heatmap
-    plt.figure(figsize=(10, 8))
-    sns.heatmap(corr_matrix, annot=True, cmap='coolwarm', fmt='.2f', linewidths=0.5)
-    
-    # Add title and labels
-    plt.title('Correlation Heatmap', fontsize=16)
-    plt.tight_layout()
-    plt.savefig(output_file)
-    
-    # Filter out correlations that are greater than the threshold (absolute value)
-    # This will exclude the diagonal (self-correlations) and correlations below the threshold
-    high_corr_matrix = corr_matrix.abs() > threshold
-    high_corr_matrix = high_corr_matrix.where(high_corr_matrix).stack().reset_index()
-    
-    # Renaming columns for clarity
-    high_corr_matrix.columns = ['Feature1', 'Feature2', 'Correlation']
-    
-    # Removing duplicate pairs (e.g., (A, B) and (B, A))
-    high_corr_matrix = high_corr_matrix[high_corr_matrix['Feature1'] < high_corr_matrix['Feature2']]
-    
+    title = 'Correlation Heatmap' if method == 'pearson' else f'Correlation Heatmap ({method.title()})'
+    if len(heatmap_order) < len(numerical_columns):
+        title += f' - top {len(heatmap_order)} of {len(numerical_columns)} columns'
+    output_file = submitChart(renderHeatmap, {"output_file": "correlation_heatmap.png", "matrix": heatmap_matrix, "title": title})
+
     correlationInfo = {"high_corr_matrix":high_corr_matrix, "output_file":output_file}
     return correlationInfo
 
+def renderHeatmap(spec):
+    '''
+    Method to render the correlation heatmap, annotated only while the cells are large enough to read
+    Args:
+        spec: dict: output file, correlation matrix and title
+    Returns:
+        str: output file
+    '''
+    sns = importModule("seaborn")
+    size = len(spec["matrix"])
+    fig = importModule("matplotlib.figure").Figure(figsize=(max(10, 0.5 * size), max(8, 0.4 * size)))
+    ax = fig.subplots()
+    sns.heatmap(spec["matrix"], annot=size <= 20, cmap='coolwarm', fmt='.2f', linewidths=0.5 if size <= 20 else 0, vmin=-1, vmax=1, ax=ax)
+
+    # Add title and labels
+    ax.set_title(spec["title"], fontsize=16)
+    return saveChart(fig, spec)
+
 def addContentToReadme(content, section = f"# Title\n"):
     '''
     Method to add content to the README.md file
@@ -667,7 +2108,7 @@ def addContentToReadme(content, section = f"# Title\n"):
         section: str: section to add the content
     '''
     try:
-      with open(OUTPUT_FILE, "a") as file:
+      with open(getOutputPath(OUTPUT_FILE), "a") as file:
           print(file.name)
           if section == f"# Title\n":
             file.write("# "+content+"\n")
@@ -722,17 +2163,18 @@ def addAnalysisSection(correlationInfo, outliersInfo, clusterInfo, analysisSumma
         narrative: dict: narrative information
         section: str: section to add the
     '''
-    correlation_output_file = correlationInfo['output_file']
+    correlation_output_file = getChartFile(correlationInfo['output_file'])
     markdown_content = f"\n\n### Correlation \n\nBelow is the correlation heatmap"
     markdown_content += f"\n\n![{correlation_output_file}]({correlation_output_file})"
     markdown_content += f"\n\n{narrative['correlation']}"
 
     outlierItems = outliersInfo['outlier_values']
     markdown_content += "\n\n### Outlier Detection \n\nBelow are the outlier details"
-    table_header = "\n|Column  |(Min,Max) |\n|------|------|\n"
-    table_rows = "\n".join([f"| {key} | {value} |" for key,value in outlierItems.items()])
+    outlierCounts = outliersInfo.get('outlier_counts', {})
+    table_header = "\n|Column  |Count |(Min,Max) |\n|------|------|------|\n"
+    table_rows = "\n".join([f"| {key} | {outlierCounts.get(key, '')} | {value} |" for key,value in outlierItems.items()])
     markdown_content += f"{table_header}{table_rows}"
-    outliers_output_file = outliersInfo['output_file']
+    outliers_output_file = getChartFile(outliersInfo['output_file'])
     markdown_content += f"\n\n![{outliers_output_file}]({outliers_output_file})"
     markdown_content += f"\n\n{narrative['outliers']}"
 
@@ -740,7 +2182,10 @@ def addAnalysisSection(correlationInfo, outliersInfo, clusterInfo, analysisSumma
     table_header = "\n|Cluster  |Count  |\n|------|------|\n"
     table_rows = "\n".join([f"| {key} | {value} |" for key,value in clusterInfo['clusters'].items()])
     markdown_content += f"{table_header}{table_rows}"
-    cluster_output_file = clusterInfo['output_file']
+    if clusterInfo.get('k_selection'):
+        best = max(clusterInfo['k_selection'], key=lambda item: item['silhouette'])
+        markdown_content += f"\n\nNumber of clusters chosen by silhouette score: {best['k']} (score {best['silhouette']:.2f})"
+    cluster_output_file = getChartFile(clusterInfo['output_file'])
     markdown_content += f"\n\n![{cluster_output_file}]({cluster_output_file})"
     markdown_content += f"\n\n{narrative['cluster']}"
 
@@ -816,25 +2261,39 @@ def createReadMeFile(df, metadata, stats, updated_values, correlationInfo, outli
         clusterInfo: dict: clusters information
         summary: dict: summary and next steps
         narrative: dict: narrative information
+    Returns:
+        str: output file
     '''
+    # Sections are appended, a README left by an earlier run is removed first
+    removeFile(getOutputPath(OUTPUT_FILE))
     addTitle(summary['title'])
     addIntroduction(summary['introduction'])
     addMetaData([{'name':col['name'], 'type':col['type'], 'description':col['description']} for col in metadata])
     addDescriptiveStatistics(stats, summary['summary'])
     addPreProcessingDetails(updated_values, clusterInfo)
     addAnalysisSection(correlationInfo, outliersInfo, clusterInfo, analysisSummary, narrative, "## Analysis\n")
+    return OUTPUT_FILE
 
-def getInsightsFromImage(imageFile):
+def getInsightsFromImage(imageFile, useCache=True):
     '''
-    Method to get insights from the image
+    Method to get insights from the image, attached to the request downscaled
     Args:
-        imageFile: str: path to the image file
+        imageFile: str: image file in the output directory
+        useCache: bool: set False to bypass the response cache
     Returns:
-        str: inference, insights, recommendation
+        str: inference, insights, recommendation, empty if the image could not be analysed
     '''
-    response = handleRequest(CONCLUSION_PROMPT, imageFile, 'get_feedback')
-    inference, insights, recommendation = json.loads(response['choices'][0]['message']['function_call']['arguments']).values()
-    return inference, insights, recommendation
+    path = getOutputPath(imageFile)
+    if not imageFile or not os.path.isfile(path):
+        print(f"Error: chart {imageFile} not found")
+        return "", "", ""
+    try:
+        response = handleRequest(CONCLUSION_PROMPT, "", 'get_feedback', useCache, path)
+        inference, insights, recommendation = json.loads(response['choices'][0]['message']['function_call']['arguments']).values()
+        return inference, insights, recommendation
+    except Exception as e:
+        print(f"Error: {e}")
+        return "", "", ""
 
 def getInsights(analysisSummary):
     '''
@@ -844,11 +2303,13 @@ def getInsights(analysisSummary):
     Returns:
         list: analysis summary with insights
     '''
-    for item in analysisSummary:
-        inference, insights, recommendation = getInsightsFromImage(item['output_file'])
-        item['inference'] = inference
-        item['insights'] = insights
-        item['recommendation'] = recommendation
+    # Requests run on a nested pool, outside the stage thread
+    useCache = not getattr(_STAGE, "force", False)
+    with ThreadPoolExecutor(max_workers=INSIGHT_WORKERS) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, getInsightsFromImage, item['output_file'], useCache) for item in analysisSummary]
+        # Copies, the analysis summary is the result of another stage
+        analysisSummary = [{**item, 'inference': inference, 'insights': insights, 'recommendation': recommendation}
+                           for item, (inference, insights, recommendation) in zip(analysisSummary, (future.result() for future in futures))]
     return analysisSummary
 
 def analyseOutliers(df, featureInfo):
@@ -861,55 +2322,105 @@ def analyseOutliers(df, featureInfo):
         dict: outliers information
     '''
     # Extract numerical columns
-    numerical_columns = [feature['name'] for feature in featureInfo if feature['stats']]
-    df[numerical_columns] = df[numerical_columns].apply(pd.to_numeric, errors='coerce')
-
-    # Compute z-scores
-    z_scores = df[numerical_columns].apply(zscore)
-    outliers = (z_scores.abs() > 3)
-    
+    numerical_columns = getStatsColumns(df, featureInfo)
+    matrix = df[numerical_columns].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    outliers = getOutlierMask(matrix, OUTLIER_METHOD)
+    outlier_counts = {col: int(count) for col, count in zip(numerical_columns, outliers.sum(axis=0))}
+
+    # Outliers as a sparse (row, column, value) index
+    rows, cols = np.nonzero(outliers)
+    outlierPoints = pd.DataFrame({'row': df.index[rows], 'column': np.array(numerical_columns, dtype=object)[cols],
+                                  'value': matrix[rows, cols]})
+    with np.errstate(invalid='ignore'):
+        minimum = np.where(outliers, matrix, np.inf).min(axis=0, initial=np.inf)
+        maximum = np.where(outliers, matrix, -np.inf).max(axis=0, initial=-np.inf)
+        normalization_factors = dict(zip(numerical_columns, np.nanmax(matrix, axis=0, initial=-np.inf) - np.nanmin(matrix, axis=0, initial=np.inf)))
+    output_file = plotOutliers(outlierPoints, numerical_columns, normalization_factors)
+
+    # No outliers found for a column gives None
+    outlier_ranges = {col: (minimum[idx], maximum[idx]) if np.isfinite(minimum[idx]) else None
+                      for idx, col in enumerate(numerical_columns)}
+    return {"outliers":outlierPoints, "outlier_values":outlier_ranges, "outlier_counts":outlier_counts, "output_file":output_file}
+
+def getOutlierMask(matrix, method):
+    '''
+    Method to flag the outliers of every column of a float matrix at once, NaN are never outliers
+    Args:
+        matrix: ndarray: rows x columns float matrix
+        method: str: zscore (absolute z-score above 3), mad (modified z-score from the median absolute
+            deviation above 3.5, from the mean absolute deviation when more than half the values are
+            the median) or iqr (outside 1.5 interquartile ranges from the quartiles)
+    Returns:
+        ndarray: boolean rows x columns mask
+    '''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'zscore':
+            missing = np.isnan(matrix)
+            count = matrix.shape[0] - missing.sum(axis=0)
+            mean = np.where(missing, 0, matrix).sum(axis=0) / count
+            # Population standard deviation, as scipy zscore
+            std = np.sqrt((np.where(missing, 0, matrix - mean) ** 2).sum(axis=0) / count)
+            return np.abs(matrix - mean) / std > 3
+        if method == 'mad':
+            median = columnQuantiles(matrix, [0.5])[0]
+            deviation = np.abs(matrix - median)
+            mad = columnQuantiles(deviation, [0.5])[0]
+            # A zero MAD would flag every value off the median, the mean absolute deviation scaled to
+            # the same normal spread is used instead and constant columns have no outliers
+            meanDeviation = np.nanmean(deviation, axis=0)
+            score = np.where(mad > 0, 0.6745 * deviation / mad, deviation / (1.253314 * meanDeviation))
+            return score > 3.5
+        if method == 'iqr':
+            q1, q3 = columnQuantiles(matrix, [0.25, 0.75])
+            spread = 1.5 * (q3 - q1)
+            return (matrix < q1 - spread) | (matrix > q3 + spread)
+    raise ValueError(f"Unknown outlier method: {method}")
+
+def plotOutliers(outlierPoints, numerical_columns, normalization_factors):
+    '''
+    Method to plot the outliers of all columns in a single chart with normalized y-axis
+    Args:
+        outlierPoints: DataFrame: outliers with row, column and value
+        numerical_columns: list: columns to be plotted
+        normalization_factors: dict: column -> range of the column values
+    Returns:
+        Future: output file, once rendered
+    '''
+    # Normalize column values for better visibility
+    labels = {col: f"{col} (Norm Factor: {normalization_factors[col]:.2f})" for col in numerical_columns}
+    points = outlierPoints if len(outlierPoints) <= SCATTER_MAX_ROWS else outlierPoints.sample(SCATTER_MAX_ROWS, random_state=42)
+    points = pd.DataFrame({
+        'row': points['row'],
+        'value': points['value'] / points['column'].map(normalization_factors).astype(np.float64),
+        'label': points['column'].map(labels)
+    })
+    return submitChart(renderOutliers, {"output_file": "outliers_combined_normalized.png", "points": points, "labels": list(labels.values())})
+
+def renderOutliers(spec):
+    '''
+    Method to render the outlier chart of plotOutliers
+    Args:
+        spec: dict: output file, normalized points with their column label and the labels of all columns
+    Returns:
+        str: output file
+    '''
+    sns = importModule("seaborn")
     # Initialize a single plot
-    plt.figure(figsize=(12, 8))
-    
-    # Assign unique colors to each column
-    palette = sns.color_palette("tab10", len(numerical_columns))
-    
-    # Loop through numerical columns and plot
-    normalization_factors = {}
-    for idx, col in enumerate(numerical_columns):
-        # Normalize column values for better visibility
-        normalization_factor = df[col].max() - df[col].min()
-        normalization_factors[col] = normalization_factor
-        normalized_values = df[col] / normalization_factor
-        
-        sns.scatterplot(
-            x=df.index[outliers[col]],  # Only plot outliers
-            y=normalized_values[outliers[col]],
-            color=palette[idx],
-            label=f"{col} (Norm Factor: {normalization_factor:.2f})"
-        )
-    output_file = "outliers_combined_normalized.png"
+    fig = importModule("matplotlib.figure").Figure(figsize=(12, 8))
+    ax = fig.subplots()
+
+    # All columns in one call, with unique colors for each column
+    sns.scatterplot(data=spec["points"], x='row', y='value', hue='label', hue_order=spec["labels"],
+                    palette=sns.color_palette("tab10", len(spec["labels"])), ax=ax)
     # Add titles and labels
-    plt.title("Outliers Across Numerical Columns (Normalized)")
-    plt.xlabel("Data Point ID")
-    plt.ylabel("Normalized Feature Value")
-    plt.legend(title="Columns (Normalization Factor)")
-    plt.tight_layout()
-    
+    ax.set_title("Outliers Across Numerical Columns (Normalized)")
+    ax.set_xlabel("Data Point ID")
+    ax.set_ylabel("Normalized Feature Value")
+    ax.legend(title="Columns (Normalization Factor)")
+
     # Save the combined chart
-    plt.savefig(output_file)
-    plt.close()
-
-    outlier_ranges = {}
-    for col in numerical_columns:
-        outlier_values = df[col][outliers[col]]
-        if not outlier_values.empty:
-            min_val, max_val = outlier_values.min(), outlier_values.max()
-            outlier_ranges[col] = (min_val, max_val)
-        else:
-            outlier_ranges[col] = None  # No outliers found for this column
-    
-    return {"outliers":outliers, "outlier_values":outlier_ranges, "output_file":output_file}
+    return saveChart(fig, spec)
 
 def provideNarrative(df, statsInfo, updated_values, correlationInfo, outliersInfo, clusterInfo):
     '''
@@ -921,54 +2432,902 @@ def provideNarrative(df, statsInfo, updated_values, correlationInfo, outliersInf
         outliersInfo: dict: outliers information
         clusterInfo: dict: clusters information
     '''
-    content = f"Columns:{df.columns}\n\nData Types:{df.dtypes}\n\nstatistics: {statsInfo}\n\nUpdated Values: {updated_values}\n\nCorrelation: {correlationInfo['high_corr_matrix']}\n\nOutliers: {outliersInfo['outlier_values']}\n\nCluster: {clusterInfo['clusters']}"
+    content = buildPrompt('get_narrative', [
+        ("Columns", getColumnTypes(df)),
+        ("Cluster", clusterInfo['clusters']),
+        ("Updated Values", updated_values),
+        ("Correlation", correlationInfo['high_corr_matrix']),
+        ("Outliers", outliersInfo['outlier_values']),
+        ("Statistics", statsInfo)
+    ])
     response = handleRequest("Provide the narrative", content, 'get_narrative')
     return json.loads(response['choices'][0]['message']['function_call']['arguments'])    
 
-def analyse(fileName):
+def useStreaming(fileName):
+    '''
+    Method to decide if the file is analysed in streaming mode, STREAMING_MODE is one of auto, on, off.
+    In auto mode files whose parsed size would not fit in MEMORY_BUDGET_MB are streamed
+    Args:
+        fileName: str: path to the file
+    Returns:
+        bool: True if the file should be streamed
+    '''
+    if STREAMING_MODE in ("on", "off"):
+        return STREAMING_MODE == "on"
+    # A parsed CSV typically takes a few times its size on disk
+    return os.path.getsize(fileName) * 3 > MEMORY_BUDGET_MB * 1024 * 1024
+
+def getStreamSource(fileName):
+    '''
+    Method to prepare reading the file in chunks, the chunk size is chosen so that a chunk, its
+    working copies and the bounded samples stay within MEMORY_BUDGET_MB
+    Args:
+        fileName: str: path to the file
+    Returns:
+        dict: file name, encoding and rows per chunk
+    '''
+    encoding = getFileEncoding(fileName)
+    head = loadFileHead({"fileName": fileName, "encoding": encoding})
+    rowBytes = max(head.memory_usage(deep=True).sum() / max(len(head), 1), 1)
+    # Raw and preprocessed samples are kept for the whole run, a chunk is copied about four times while processed
+    available = MEMORY_BUDGET_MB * 1024 * 1024 - 2 * SAMPLE_ROWS * rowBytes
+    chunkRows = int(max(available / (4 * rowBytes), 1000))
+    print(f"Streaming {fileName} in chunks of {chunkRows} rows")
+    return {"fileName": fileName, "encoding": encoding, "chunkRows": chunkRows}
+
+def readChunks(source, columns=None):
+    '''
+    Method to read the file chunk by chunk, from the Arrow sidecar when there is one
+    Args:
+        source: dict: streaming source from getStreamSource
+        columns: list: columns to be read, all columns if not given
+    Returns:
+        iterator: DataFrame chunks, the index continues across chunks
+    '''
+    reader = openSidecar(source["fileName"])
+    if reader is None:
+        yield from pd.read_csv(source["fileName"], encoding=source["encoding"], chunksize=source["chunkRows"], usecols=columns)
+        return
+    start = 0
+    for idx in range(reader.num_record_batches):
+        batch = reader.get_batch(idx)
+        if columns is not None:
+            batch = batch.select(columns)
+        # Batches written for a larger memory budget are split, slices of the memory-mapped batch are not copied
+        for offset in range(0, batch.num_rows, source["chunkRows"]):
+            chunk = batch.slice(offset, source["chunkRows"]).to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+
+def ingestSidecar(source, featureInfo):
+    '''
+    Method to convert the file into a typed Arrow sidecar chunk by chunk, so that the streaming passes
+    and later runs read the sidecar instead of parsing the file
+    Args:
+        source: dict: streaming source from getStreamSource
+        featureInfo: dict: feature information
+    '''
+    if CACHE_DISABLED or openSidecar(source["fileName"]) is not None:
+        return
+    path = getSidecarPath(source["fileName"])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    writer = None
     try:
-        df = loadFile(fileName)
-        print("File loaded successfully")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            for chunk in readChunks(source):
+                chunk = applyColumnTypes(chunk, featureInfo, downcast=False)
+                if writer is None:
+                    # Chunks must share one schema: integers may hold nulls in later chunks and empty columns are strings
+                    fields = []
+                    for field in pa.Schema.from_pandas(chunk, preserve_index=False):
+                        if pa.types.is_integer(field.type):
+                            field = field.with_type(pa.float64())
+                        elif pa.types.is_null(field.type):
+                            field = field.with_type(pa.string())
+                        fields.append(field)
+                    schema = pa.schema(fields, metadata={b'feature_info': json.dumps(featureInfo).encode('utf-8')})
+                    writer = pa.ipc.new_file(sink, schema)
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            if writer is not None:
+                writer.close()
+        os.replace(tmp_path, path)
+        evictCache(os.path.dirname(path), DATASET_CACHE_MAX_SIZE_MB)
+    except (OSError, pa.ArrowException, TypeError, ValueError) as e:
+        print(f"Error writing sidecar: {e}")
+        removeFile(tmp_path)
+
+def loadFileHead(source, nrows=1000):
+    '''
+    Method to load the first rows of the file, used for metadata in streaming mode
+    Args:
+        source: dict: streaming source from getStreamSource
+        nrows: int: number of rows to load
+    Returns:
+        DataFrame: first rows of the file
+    '''
+    reader = openSidecar(source["fileName"])
+    if reader is not None and reader.num_record_batches:
+        return reader.get_batch(0).slice(0, nrows).to_pandas()
+    return pd.read_csv(source["fileName"], encoding=source["encoding"], nrows=nrows)
 
-        featureInfo = getFeatureInfo(df)
-        print("Feature Info fetched successfully")
+def sampleRows(sample, chunk, size, rng):
+    '''
+    Method to maintain a uniform random sample of bounded size over a stream of chunks, every row gets
+    a random key and the rows with the smallest keys are kept
+    Args:
+        sample: DataFrame: current sample with a _key column, None for the first chunk
+        chunk: DataFrame: next chunk
+        size: int: maximum number of rows to keep
+        rng: Generator: random generator
+    Returns:
+        DataFrame: updated sample
+    '''
+    keys = rng.random(len(chunk))
+    if sample is not None and len(sample) >= size:
+        # Only rows with a smaller key than the current largest can enter the sample
+        keep = keys < sample['_key'].max()
+        chunk, keys = chunk[keep], keys[keep]
+    chunk = chunk.assign(_key=keys)
+    combined = chunk if sample is None else pd.concat([sample, chunk])
+    return combined.nsmallest(size, '_key') if len(combined) > size else combined
+
+def finishSample(sample):
+    '''
+    Method to get the final sample in file order without the sampling key
+    Args:
+        sample: DataFrame: sample from sampleRows
+    Returns:
+        DataFrame: sampled rows
+    '''
+    return sample.drop(columns='_key').sort_index()
 
-        statsInfo = getDescriptiveStats(df, featureInfo)
-        print("Descriptive Stats populated successfully")
+def compactSketch(levels, rng):
+    '''
+    Method to compact a quantile sketch, every level holding more than SKETCH_SIZE values is sorted and
+    every other value is promoted to the next level, where each value stands for twice as many
+    Args:
+        levels: list: arrays of values, values at level i have weight 2**i
+        rng: Generator: random generator
+    '''
+    level = 0
+    while level < len(levels):
+        if len(levels[level]) > SKETCH_SIZE:
+            items = np.sort(levels[level])
+            # An odd value out stays on its level
+            keep, items = (items[-1:], items[:-1]) if len(items) % 2 else (items[:0], items)
+            if level + 1 == len(levels):
+                levels.append(items[:0])
+            levels[level + 1] = np.concatenate([levels[level + 1], items[rng.integers(2)::2]])
+            levels[level] = keep
+        level += 1
+
+def updateSketch(levels, values, rng):
+    '''
+    Method to add values to a quantile sketch
+    Args:
+        levels: list: sketch levels, empty list for a new sketch
+        values: ndarray: values to be added, NaN are ignored
+        rng: Generator: random generator
+    '''
+    values = values[~np.isnan(values)]
+    if not levels:
+        levels.append(values[:0])
+    levels[0] = np.concatenate([levels[0], values])
+    compactSketch(levels, rng)
 
-        df, updatedValues = dataPreprocessing(df,featureInfo, statsInfo)
-        print("Preprocessing done successfully")
+def mergeSketch(levels, other, rng):
+    '''
+    Method to merge another quantile sketch into this one
+    Args:
+        levels: list: sketch levels, updated in place
+        other: list: sketch levels to be merged
+        rng: Generator: random generator
+    '''
+    for level, values in enumerate(other):
+        if level == len(levels):
+            levels.append(values[:0])
+        levels[level] = np.concatenate([levels[level], values])
+    compactSketch(levels, rng)
 
-        correlationInfo = getHighCorrelation(df, featureInfo)
-        print("Correlation done successfully")
+def sketchQuantiles(levels, quantiles):
+    '''
+    Method to estimate quantiles from a quantile sketch, exact while the sketch has not been compacted
+    Args:
+        levels: list: sketch levels
+        quantiles: list: quantiles between 0 and 1
+    Returns:
+        list: estimated value per quantile, NaN for an empty sketch
+    '''
+    values = np.concatenate(levels) if levels else np.empty(0)
+    if len(values) == 0:
+        return [np.nan for _ in quantiles]
+    weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(levels)])
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    # Rank at the centre of each weighted value, equal to the position for unit weights
+    ranks = np.cumsum(weights) - weights / 2 - 0.5
+    return [float(np.interp(q * (weights.sum() - 1), ranks, values)) for q in quantiles]
+
+def mergeMoments(moments, data):
+    '''
+    Method to merge the count, mean and co-moment matrix of a block of complete rows into running
+    moments, using the pairwise update of Chan et al.
+    Args:
+        moments: dict: count, mean and comoment of the rows seen so far, None for the first block
+        data: ndarray: rows x columns float matrix without NaN
+    Returns:
+        dict: merged moments
+    '''
+    count = len(data)
+    mean = data.mean(axis=0) if count else np.zeros(data.shape[1])
+    centered = data - mean
+    block = {"count": count, "mean": mean, "comoment": centered.T @ centered}
+    if moments is None or moments["count"] == 0:
+        return block
+    if count == 0:
+        return moments
+    total = moments["count"] + count
+    delta = mean - moments["mean"]
+    return {
+        "count": total,
+        "mean": moments["mean"] + delta * count / total,
+        "comoment": moments["comoment"] + block["comoment"] + np.outer(delta, delta) * moments["count"] * count / total
+    }
+
+def streamDescriptiveStats(source, featureInfo, columnForStats):
+    '''
+    Method to get the descriptive statistics in one pass over the file chunks, with Welford mean and
+    variance, exact min/max/null/invalid counts and quantiles from a mergeable sketch
+    Args:
+        source: dict: streaming source from getStreamSource
+        featureInfo: dict: feature information
+        columnForStats: list: columns to be profiled
+    Returns:
+        dict: descriptive statistics in the format of getDescriptiveStats
+    '''
+    featureIndex = getFeatureIndex(featureInfo)
+    minValues = np.array([getMinValue(featureIndex, col) for col in columnForStats], dtype=np.float64)
+    size = len(columnForStats)
+    count, mean, m2 = np.zeros(size), np.zeros(size), np.zeros(size)
+    nulls, invalid = np.zeros(size, dtype=np.int64), np.zeros(size, dtype=np.int64)
+    minimum, maximum = np.full(size, np.inf), np.full(size, -np.inf)
+    sketches = [[] for _ in columnForStats]
+    rng = np.random.default_rng(42)
+    # Only the stats columns are needed for profiling
+    for chunk in readChunks(source, columnForStats):
+        matrix = chunk[columnForStats].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+        missing = np.isnan(matrix)
+        chunkCount = (~missing).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            chunkMean = np.where(chunkCount > 0, np.where(missing, 0, matrix).sum(axis=0) / chunkCount, 0)
+            chunkM2 = (np.where(missing, 0, matrix - chunkMean) ** 2).sum(axis=0)
+            total = count + chunkCount
+            delta = chunkMean - mean
+            share = np.where(total > 0, chunkCount / total, 0)
+            m2 += chunkM2 + delta ** 2 * count * share
+            mean += delta * share
+            count = total
+            invalid += (matrix < minValues).sum(axis=0)
+            minimum = np.fmin(minimum, np.where(missing, np.inf, matrix).min(axis=0, initial=np.inf))
+            maximum = np.fmax(maximum, np.where(missing, -np.inf, matrix).max(axis=0, initial=-np.inf))
+        nulls += missing.sum(axis=0)
+        for idx in range(size):
+            updateSketch(sketches[idx], matrix[:, idx], rng)
+
+    descriptiveStats = {}
+    for idx, col in enumerate(columnForStats):
+        quartiles = sketchQuantiles(sketches[idx], [0.25, 0.5, 0.75])
+        hasValues = count[idx] > 0
+        descriptiveStats[col] = {
+            "count": float(count[idx]),
+            "mean": float(mean[idx]) if hasValues else np.nan,
+            "std": float(np.sqrt(m2[idx] / (count[idx] - 1))) if count[idx] > 1 else np.nan,
+            "min": float(minimum[idx]) if hasValues else np.nan,
+            "25%": quartiles[0], "50%": quartiles[1], "75%": quartiles[2],
+            "max": float(maximum[idx]) if hasValues else np.nan,
+            "null": int(nulls[idx]),
+            "invalid": int(invalid[idx])
+        }
+    return descriptiveStats
 
-        outliersInfo = analyseOutliers(df, featureInfo)
-        print("Outliers analysis done successfully")
+def streamPreprocessing(source, featureInfo, statsInfo):
+    '''
+    Method to preprocess the file chunk by chunk with the global column means, accumulating the
+    co-moments of the preprocessed stats columns and keeping a bounded random sample of rows. The mad
+    and iqr outlier detectors also get a quantile sketch of every preprocessed stats column
+    Args:
+        source: dict: streaming source from getStreamSource
+        featureInfo: dict: feature information
+        statsInfo: dict: descriptive statistics
+    Returns:
+        DataFrame: sample of SAMPLE_ROWS preprocessed rows
+        dict: count of dropped rows and of out of range values per column
+        dict: columns, count, mean, comoment, min, max and sketches of the preprocessed stats columns
+    '''
+    means = {col: stats['mean'] for col, stats in statsInfo.items()}
+    update_details = {"dropped_rows": 0, "out_of_range_values": {col: 0 for col in statsInfo.keys()}}
+    moments, sample, columns = None, None, None
+    rng = np.random.default_rng(42)
+    for chunk in readChunks(source):
+        processed, details = dataPreprocessing(chunk, featureInfo, statsInfo, means)
+        update_details["dropped_rows"] += details["dropped_rows"]
+        for col, value in details["out_of_range_values"].items():
+            update_details["out_of_range_values"][col] += value
+        if columns is None:
+            columns = getStatsColumns(processed, featureInfo)
+            minimum, maximum = np.full(len(columns), np.inf), np.full(len(columns), -np.inf)
+            sketches = [[] for _ in columns] if OUTLIER_METHOD != 'zscore' else None
+        data = processed[columns].to_numpy(dtype=np.float64)
+        moments = mergeMoments(moments, data)
+        if len(data):
+            minimum, maximum = np.fmin(minimum, data.min(axis=0)), np.fmax(maximum, data.max(axis=0))
+        if sketches is not None:
+            for idx in range(len(columns)):
+                updateSketch(sketches[idx], data[:, idx], rng)
+        sample = sampleRows(sample, processed, SAMPLE_ROWS, rng)
+    moments.update({"columns": columns, "min": minimum, "max": maximum, "sketches": sketches})
+    return finishSample(sample), update_details, moments
+
+def correlationFromMoments(moments):
+    '''
+    Method to get the correlation matrix from streamed co-moments
+    Args:
+        moments: dict: moments from streamPreprocessing
+    Returns:
+        DataFrame: correlation matrix
+    '''
+    variance = np.diag(moments["comoment"])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = moments["comoment"] / np.sqrt(np.outer(variance, variance))
+    return pd.DataFrame(corr, index=moments["columns"], columns=moments["columns"])
 
-        summaryInfo = getSummaryAndNextSteps(df,statsInfo)
-        print("Summary generation done successfully")
+def getStreamOutlierFences(moments):
+    '''
+    Method to get the values beyond which OUTLIER_METHOD flags outliers, from the streamed moments for zscore
+    and from the quantile sketches of the preprocessed columns for mad and iqr, with the thresholds of getOutlierMask
+    Args:
+        moments: dict: moments from streamPreprocessing
+    Returns:
+        ndarray: lower fence per column
+        ndarray: upper fence per column
+    '''
+    if OUTLIER_METHOD == 'zscore':
+        # Population standard deviation, as scipy zscore
+        spread = 3 * np.sqrt(np.diag(moments["comoment"]) / max(moments["count"], 1))
+        return moments["mean"] - spread, moments["mean"] + spread
+    if OUTLIER_METHOD not in ('mad', 'iqr'):
+        raise ValueError(f"Unknown outlier method: {OUTLIER_METHOD}")
+    lower, upper = [], []
+    for levels in moments["sketches"]:
+        if OUTLIER_METHOD == 'iqr':
+            q1, q3 = sketchQuantiles(levels, [0.25, 0.75])
+            lower.append(q1 - 1.5 * (q3 - q1))
+            upper.append(q3 + 1.5 * (q3 - q1))
+            continue
+        median = sketchQuantiles(levels, [0.5])[0]
+        # The deviations of the sketch values keep their weights, so the sketch of the deviations comes for free
+        deviations = [np.abs(items - median) for items in levels]
+        mad = sketchQuantiles(deviations, [0.5])[0]
+        if mad > 0:
+            spread = 3.5 * mad / 0.6745
+        else:
+            weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(deviations)])
+            spread = 3.5 * 1.253314 * np.average(np.concatenate(deviations), weights=weights) if weights.sum() else np.nan
+        lower.append(median - spread)
+        upper.append(median + spread)
+    return np.array(lower, dtype=np.float64), np.array(upper, dtype=np.float64)
 
-        clusterInfo = applyKMeansClustering(df, featureInfo)
-        print("CLustering done successfully")
+def streamOutliers(source, featureInfo, statsInfo, moments):
+    '''
+    Method to find the OUTLIER_METHOD outliers chunk by chunk from fences computed on the streamed moments or sketches,
+    the outlier ranges are exact for the fences and a bounded random sample of outliers is plotted
+    Args:
+        source: dict: streaming source from getStreamSource
+        featureInfo: dict: feature information
+        statsInfo: dict: descriptive statistics
+        moments: dict: moments from streamPreprocessing
+    Returns:
+        dict: outliers information in the format of analyseOutliers
+    '''
+    means = {col: stats['mean'] for col, stats in statsInfo.items()}
+    columns = moments["columns"]
+    lower, upper = getStreamOutlierFences(moments)
+    outlierMin, outlierMax = np.full(len(columns), np.inf), np.full(len(columns), -np.inf)
+    outlierCount = np.zeros(len(columns), dtype=np.int64)
+    points = None
+    rng = np.random.default_rng(42)
+    for chunk in readChunks(source):
+        processed, _ = dataPreprocessing(chunk, featureInfo, statsInfo, means)
+        data = processed[columns].to_numpy(dtype=np.float64)
+        with np.errstate(invalid='ignore'):
+            outliers = (data < lower) | (data > upper)
+        outlierCount += outliers.sum(axis=0)
+        outlierMin = np.fmin(outlierMin, np.where(outliers, data, np.inf).min(axis=0, initial=np.inf))
+        outlierMax = np.fmax(outlierMax, np.where(outliers, data, -np.inf).max(axis=0, initial=-np.inf))
+        rows, cols = np.nonzero(outliers)
+        chunkPoints = pd.DataFrame({'row': processed.index[rows], 'column': np.array(columns, dtype=object)[cols], 'value': data[rows, cols]})
+        points = sampleRows(points, chunkPoints, SAMPLE_ROWS, rng)
+
+    outlierPoints = finishSample(points).reset_index(drop=True)
+    normalization_factors = dict(zip(columns, moments["max"] - moments["min"]))
+    output_file = plotOutliers(outlierPoints, columns, normalization_factors)
+    outlier_ranges = {col: (outlierMin[idx], outlierMax[idx]) if np.isfinite(outlierMin[idx]) else None
+                      for idx, col in enumerate(columns)}
+    outlier_counts = {col: int(outlierCount[idx]) for idx, col in enumerate(columns)}
+    return {"outliers": outlierPoints, "outlier_values": outlier_ranges, "outlier_counts": outlier_counts, "output_file": output_file}
+
+def getStageBaseKey(fileName):
+    '''
+    Method to get the key the keys of the stages without dependencies are derived from
+    Args:
+        fileName: str: path of the dataset
+    Returns:
+        str: hash of the file fingerprint and of the streaming mode
+    '''
+    return getCacheKey({"file": getFileFingerprint(fileName), "streaming": useStreaming(fileName)})
 
-        analysisSummary = advancedAnalytics(df, statsInfo, summaryInfo)
-        print("Analysis done successfully")
+def getCodeHash(function):
+    '''
+    Method to hash the source of a function and of the functions of this script it calls, directly or not
+    Args:
+        function: function: stage function
+    Returns:
+        str: sha256 hex digest of the sources
+    '''
+    if function.__code__ in _CODE_HASHES:
+        return _CODE_HASHES[function.__code__]
+    sources = {}
+    queue = [function]
+    while queue:
+        item = queue.pop()
+        if item.__code__ in sources:
+            continue
+        try:
+            sources[item.__code__] = inspect.getsource(item)
+        except (OSError, TypeError):
+            sources[item.__code__] = item.__code__.co_code.hex()
+        codes = [item.__code__]
+        while codes:
+            code = codes.pop()
+            codes.extend(const for const in code.co_consts if inspect.iscode(const))
+            queue.extend(value for value in (globals().get(name) for name in code.co_names)
+                         if inspect.isfunction(value) and value.__module__ == __name__)
+    _CODE_HASHES[function.__code__] = hashlib.sha256("".join(sorted(sources.values())).encode("utf-8")).hexdigest()
+    return _CODE_HASHES[function.__code__]
+
+def getStageKey(name, stage, baseKey, fingerprints):
+    '''
+    Method to get the key of a stage from its settings, its code and the fingerprints of the stages it depends on
+    Args:
+        name: str: stage name
+        stage: tuple: (function, dependencies, kind, message)
+        baseKey: str: key of the dataset, used by the stages without dependencies
+        fingerprints: dict: stage name -> fingerprint of its result
+    Returns:
+        str: stage key
+    '''
+    settings = {setting: sorted(value) if isinstance(value, set) else value
+                for setting, value in ((setting, globals()[setting]) for setting in STAGE_SETTINGS.get(name, []))}
+    inputs = [fingerprints[dependency] for dependency in stage[1]] or [baseKey]
+    return getCacheKey({"stage": name, "settings": settings, "code": getCodeHash(stage[0]), "inputs": inputs})
 
-        analysisSummary = getInsights(analysisSummary)
-        print("Generated insights successfully")
+def getForcedStages(stages):
+    '''
+    Method to get the stages in FORCE_STAGES and every stage depending on them
+    Args:
+        stages: dict: stage name -> (function, dependencies, kind, message)
+    Returns:
+        set: stage names
+    '''
+    if "all" in FORCE_STAGES:
+        return set(stages)
+    forced = FORCE_STAGES & set(stages)
+    changed = True
+    while changed:
+        dependents = {name for name, stage in stages.items() if forced & set(stage[1])}
+        changed = not dependents <= forced
+        forced |= dependents
+    return forced
+
+def getStageArtifactPath(key):
+    '''
+    Method to get the path of a stored stage result
+    Args:
+        key: str: stage key
+    Returns:
+        str: path of the artifact
+    '''
+    return os.path.join(CACHE_DIR, "stages", f"{key}.pkl")
+
+def resolveFutures(value, wait=True):
+    '''
+    Method to replace the charts still rendering in a stage result by their output files
+    Args:
+        value: object: stage result
+        wait: bool: set False to use the file names without waiting for the charts
+    Returns:
+        object: stage result without futures
+    '''
+    if isinstance(value, Future):
+        return getChartFile(value) if wait else value.output_file
+    if isinstance(value, dict):
+        return {key: resolveFutures(item, wait) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(resolveFutures(item, wait) for item in value)
+    return value
+
+def updateFingerprint(digest, value):
+    '''
+    Method to add a value to a fingerprint, by content so that a stored result matches the result it was stored from
+    Args:
+        digest: hash: sha256 being computed
+        value: object: value of a stage result
+    '''
+    if isinstance(value, dict):
+        digest.update(b"{")
+        for key, item in value.items():
+            updateFingerprint(digest, key)
+            updateFingerprint(digest, item)
+        digest.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"[")
+        for item in value:
+            updateFingerprint(digest, item)
+        digest.update(b"]")
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(repr((type(value).__name__, value.shape, value.to_frame().dtypes.to_dict() if isinstance(value, pd.Series) else value.dtypes.to_dict())).encode("utf-8"))
+        try:
+            digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        except TypeError:
+            digest.update(value.to_json(date_format="iso").encode("utf-8"))
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        digest.update(repr((value.dtype.str, value.shape)).encode("utf-8"))
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, np.ndarray):
+        updateFingerprint(digest, value.tolist())
+    else:
+        digest.update(repr(value).encode("utf-8"))
 
-        narrative = provideNarrative(df, statsInfo, updatedValues, correlationInfo, outliersInfo, clusterInfo)
-        print("Narrative generated successfully")
+def getResultFingerprint(value):
+    '''
+    Method to get a fingerprint of a stage result, the keys of the stages depending on it are derived from it
+    Args:
+        value: object: stage result
+    Returns:
+        str: sha256 hex digest of the result, charts still rendering count as the file they are written to
+    '''
+    digest = hashlib.sha256()
+    updateFingerprint(digest, resolveFutures(value, wait=False))
+    return digest.hexdigest()
 
-        #Add details to the README.md file
-        createReadMeFile(df, featureInfo, statsInfo, updatedValues, correlationInfo, outliersInfo, clusterInfo, summaryInfo, analysisSummary, narrative)
-        print("Output written to README.md")
+def getOutputFiles(value):
+    '''
+    Method to get the output files written by a stage, from the output_file entries of its result
+    Args:
+        value: object: stage result without futures
+    Returns:
+        list: output files
+    '''
+    if isinstance(value, dict):
+        files = [value['output_file']] if isinstance(value.get('output_file'), str) and value['output_file'] else []
+        return files + [name for key, item in value.items() if key != 'output_file' for name in getOutputFiles(item)]
+    if isinstance(value, (list, tuple)):
+        return [name for item in value for name in getOutputFiles(item)]
+    return []
+
+def saveStageArtifact(key, result):
+    '''
+    Method to store a stage result together with the output files it wrote
+    Args:
+        key: str: stage key
+        result: object: stage result
+    '''
+    try:
+        result = resolveFutures(result)
+        files = {}
+        for name in ([result] if isinstance(result, str) else getOutputFiles(result)):
+            if os.path.isfile(getOutputPath(name)):
+                with open(getOutputPath(name), "rb") as f:
+                    files[name] = f.read()
+        path = getStageArtifactPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"result": result, "files": files}, f)
+        os.replace(tmp_path, path)
+        evictCache(os.path.dirname(path), STAGE_CACHE_MAX_SIZE_MB)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError) as e:
+        print(f"Error storing stage: {e}")
+
+def loadStageArtifact(key):
+    '''
+    Method to load a stored stage result and restore the output files it wrote
+    Args:
+        key: str: stage key
+    Returns:
+        dict: {"result": stage result} or None if not stored
+    '''
+    path = getStageArtifactPath(key)
+    try:
+        with open(path, "rb") as f:
+            artifact = pickle.load(f)
+        for name, content in artifact["files"].items():
+            with open(getOutputPath(name), "wb") as f:
+                f.write(content)
+        os.utime(path)
+        return {"result": artifact["result"]}
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, AttributeError, ImportError) as e:
+        print(f"Error loading stage: {e}")
+        return None
+
+def runStage(name, function, results, dependencies, force=False):
+    '''
+    Method to run a stage, modules imported by the stage are reported against it and the stage is traced
+    with the rows and columns of its result, or of its largest input if the result is not a dataframe
+    Args:
+        name: str: stage name
+        function: function: stage function
+        results: dict: results of the completed stages
+        dependencies: list: stages the stage depends on
+        force: bool: True if the stage is in FORCE_STAGES, its LLM calls then bypass the response cache
+    Returns:
+        object: stage result
+    '''
+    _STAGE.name = name
+    _STAGE.force = force
+    try:
+        with traceSpan(name, "stage") as event:
+            result = function(results)
+            shapes = [getFrameShape(value) for value in [result] + [results[dependency] for dependency in dependencies]]
+            shape = shapes[0] or max(filter(None, shapes), default=None)
+            if shape:
+                event["rows"], event["columns"] = shape
+        return result
+    finally:
+        _STAGE.name = "main"
+        _STAGE.force = False
+
+_STAGE_POOLS = None
+_STAGE_POOLS_LOCK = threading.Lock()
+
+def getStagePools():
+    '''
+    Method to get the IO and CPU pools running the stages, shared by all datasets of a batch
+    Returns:
+        dict: kind -> ThreadPoolExecutor
+    '''
+    global _STAGE_POOLS
+    with _STAGE_POOLS_LOCK:
+        if _STAGE_POOLS is None:
+            _STAGE_POOLS = {"io": ThreadPoolExecutor(max_workers=IO_WORKERS), "cpu": ThreadPoolExecutor(max_workers=CPU_WORKERS)}
+        return _STAGE_POOLS
+
+def runStages(stages, baseKey=None):
+    '''
+    Method to run the analysis stages as a dependency graph, every stage is started as soon as the
+    stages it depends on are done. LLM stages run on the IO pool and local computation on the CPU pool.
+    With a base key, the key of a stage is known once the stages it depends on have a result, and a
+    result stored by an earlier run under that key is loaded instead of running the stage. The dataset
+    stages are not stored, their key stands in for their result and they only run when a stage needs them
+    Args:
+        stages: dict: stage name -> (function, dependencies, kind, message), function receives the
+            dict of results of the completed stages, kind is "io" or "cpu"
+        baseKey: str: key of the dataset, None to run every stage
+    Returns:
+        dict: stage name -> result
+    '''
+    results = {}
+    useKeys = baseKey is not None and not CACHE_DISABLED
+    forced = getForcedStages(stages)
+    keys = {}
+    fingerprints = {}
+    # Stages that have to run, every stage without keys
+    missed = set() if useKeys else set(stages)
+
+    def resolveKeys():
+        changed = True
+        while changed:
+            changed = False
+            for name, stage in stages.items():
+                if name in keys or not all(dependency in fingerprints for dependency in stage[1]):
+                    continue
+                keys[name] = getStageKey(name, stage, baseKey, fingerprints)
+                changed = True
+                if name in UNCACHED_STAGES:
+                    fingerprints[name] = keys[name]
+                    continue
+                # Recording and replaying run every stage, so that all LLM calls go through the transport
+                artifact = None if name in forced or LLM_TRANSPORT != "http" else loadStageArtifact(keys[name])
+                if artifact is None:
+                    missed.add(name)
+                else:
+                    results[name] = artifact["result"]
+                    fingerprints[name] = getResultFingerprint(results[name])
+                    print(f"{stages[name][3]} (cached)")
+
+    running = {}
+    completed = []
+    pools = getStagePools()
+    try:
+        if useKeys:
+            resolveKeys()
+        while True:
+            # Run the stages missed and the dataset stages they depend on
+            needed = set()
+            queue = [name for name in missed if name not in results]
+            while queue:
+                name = queue.pop()
+                if name not in needed and name not in results:
+                    needed.add(name)
+                    queue.extend(stages[name][1])
+            pending = [name for name in stages if name in needed and name not in running.values()]
+            for name in pending:
+                function, dependencies, kind, message = stages[name]
+                if all(dependency in results for dependency in dependencies):
+                    # Stages see the output directory of this dataset
+                    running[pools[kind].submit(contextvars.copy_context().run, runStage, name, function, results, dependencies, name in FORCE_STAGES)] = name
+            if not running:
+                if pending:
+                    raise RuntimeError(f"Unresolvable stage dependencies: {pending}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    # Let the stages already running finish, do not start any new stage
+                    for other in running:
+                        other.cancel()
+                    wait(running)
+                    raise
+                completed.append(name)
+                print(stages[name][3])
+                # The result gives the keys of the stages depending on it, which may be stored already
+                if useKeys and name not in UNCACHED_STAGES:
+                    fingerprints[name] = getResultFingerprint(results[name])
+                    resolveKeys()
+    finally:
+        # Stored once the charts of the run are rendered, completed stages are kept even if a later one failed
+        for name in completed:
+            if name in keys and name not in UNCACHED_STAGES:
+                saveStageArtifact(keys[name], results[name])
+    return results
+
+def analyse(fileName, outputDir="."):
+    '''
+    Method to analyse a dataset and write the README and charts
+    Args:
+        fileName: str: path of the dataset
+        outputDir: str: directory the README and charts are written to
+    Returns:
+        bool: True if the analysis completed
+    '''
+    _OUTPUT_DIR.set(outputDir)
+    _DATASET.set(fileName)
+    try:
+        os.makedirs(outputDir, exist_ok=True)
+        stages = {
+            # A sidecar written by an earlier run holds the typed dataset and its feature information
+            "sidecarInfo": (lambda r: getSidecarFeatureInfo(fileName), [], "cpu", "Sidecar checked successfully"),
+            "rawDf": (lambda r: None if r["sidecarInfo"] else loadFile(fileName), ["sidecarInfo"], "cpu", "File loaded successfully"),
+            "featureInfo": (lambda r: r["sidecarInfo"] or getFeatureInfo(r["rawDf"]), ["sidecarInfo", "rawDf"], "io", "Feature Info fetched successfully"),
+            "df": (lambda r: loadDataset(fileName, r["rawDf"], r["featureInfo"]), ["rawDf", "featureInfo"], "cpu", "Dataset typed successfully"),
+            "statsInfo": (lambda r: getDescriptiveStats(r["df"], r["featureInfo"]), ["df", "featureInfo"], "cpu", "Descriptive Stats populated successfully"),
+            "preprocessed": (lambda r: dataPreprocessing(r["df"], r["featureInfo"], r["statsInfo"]), ["df", "featureInfo", "statsInfo"], "cpu", "Preprocessing done successfully"),
+            "correlationInfo": (lambda r: getHighCorrelation(r["preprocessed"][0], r["featureInfo"]), ["preprocessed", "featureInfo"], "cpu", "Correlation done successfully"),
+            "outliersInfo": (lambda r: analyseOutliers(r["preprocessed"][0], r["featureInfo"]), ["preprocessed", "featureInfo"], "cpu", "Outliers analysis done successfully"),
+            "summaryInfo": (lambda r: getSummaryAndNextSteps(r["df"], r["statsInfo"]), ["df", "statsInfo"], "io", "Summary generation done successfully"),
+            "clusterInfo": (lambda r: applyKMeansClustering(r["preprocessed"][0], r["featureInfo"]), ["preprocessed", "featureInfo"], "cpu", "CLustering done successfully"),
+            "analysisSummary": (lambda r: advancedAnalytics(r["preprocessed"][0], r["statsInfo"], r["summaryInfo"]), ["preprocessed", "statsInfo", "summaryInfo"], "io", "Analysis done successfully"),
+            "insights": (lambda r: getInsights(r["analysisSummary"]), ["analysisSummary"], "io", "Generated insights successfully"),
+            "narrative": (lambda r: provideNarrative(r["preprocessed"][0], r["statsInfo"], r["preprocessed"][1], r["correlationInfo"], r["outliersInfo"], r["clusterInfo"]),
+                          ["preprocessed", "statsInfo", "correlationInfo", "outliersInfo", "clusterInfo"], "io", "Narrative generated successfully"),
+            #Add details to the README.md file
+            "readme": (lambda r: createReadMeFile(r["preprocessed"][0], r["featureInfo"], r["statsInfo"], r["preprocessed"][1], r["correlationInfo"], r["outliersInfo"], r["clusterInfo"], r["summaryInfo"], r["insights"], r["narrative"]),
+                       ["preprocessed", "featureInfo", "statsInfo", "correlationInfo", "outliersInfo", "clusterInfo", "summaryInfo", "insights", "narrative"], "cpu", "Output written to README.md"),
+        }
+        if useStreaming(fileName):
+            # Only bounded samples are held in memory, the statistics are accumulated over file chunks
+            stages.update({
+                "source": (lambda r: getStreamSource(fileName), [], "cpu", "Streaming source prepared successfully"),
+                "rawDf": (lambda r: loadFileHead(r["source"]), ["source", "sidecarInfo"], "cpu", "File sample loaded successfully"),
+                "df": (lambda r: applyColumnTypes(r["rawDf"], r["featureInfo"], downcast=False), ["rawDf", "featureInfo"], "cpu", "Dataset typed successfully"),
+                "ingested": (lambda r: ingestSidecar(r["source"], r["featureInfo"]), ["source", "featureInfo"], "cpu", "Sidecar ingested successfully"),
+                "statsInfo": (lambda r: streamDescriptiveStats(r["source"], r["featureInfo"], getStatsColumns(r["df"], r["featureInfo"])),
+                              ["source", "df", "featureInfo", "ingested"], "cpu", "Descriptive Stats populated successfully"),
+                "preprocessed": (lambda r: streamPreprocessing(r["source"], r["featureInfo"], r["statsInfo"]),
+                                 ["source", "featureInfo", "statsInfo"], "cpu", "Preprocessing done successfully"),
+                # Rank correlation cannot be streamed, it is computed on the sample
+                "correlationInfo": (lambda r: getHighCorrelation(r["preprocessed"][0], r["featureInfo"],
+                                                                  corr_matrix=correlationFromMoments(r["preprocessed"][2]) if CORRELATION_METHOD == "pearson" else None),
+                                    ["preprocessed", "featureInfo"], "cpu", "Correlation done successfully"),
+                "outliersInfo": (lambda r: streamOutliers(r["source"], r["featureInfo"], r["statsInfo"], r["preprocessed"][2]),
+                                 ["source", "featureInfo", "statsInfo", "preprocessed"], "cpu", "Outliers analysis done successfully"),
+            })
+        runStages(stages, getStageBaseKey(fileName))
+        return True
     
     except Exception as e:
         print(f"Error: {e}")
+        return False
+
+def getBatchFiles(patterns):
+    '''
+    Method to expand the files and glob patterns of a batch and assign each dataset an output directory
+    Args:
+        patterns: list: files or glob patterns
+    Returns:
+        dict: file name -> output directory
+    '''
+    batch = {}
+    for pattern in patterns:
+        for fileName in sorted(glob.glob(pattern)) or [pattern]:
+            if fileName in batch:
+                continue
+            name = os.path.splitext(os.path.basename(fileName))[0]
+            outputDir = os.path.join(BATCH_OUTPUT_DIR, name)
+            # Datasets with the same name in different directories get numbered directories
+            suffix = 1
+            while outputDir in batch.values():
+                suffix += 1
+                outputDir = os.path.join(BATCH_OUTPUT_DIR, f"{name}_{suffix}")
+            batch[fileName] = outputDir
+    return batch
+
+def analyseTimed(fileName, outputDir):
+    '''
+    Method to analyse a dataset of a batch and time it
+    Args:
+        fileName: str: path of the dataset
+        outputDir: str: directory the README and charts are written to
+    Returns:
+        tuple: True if the analysis completed, seconds taken
+    '''
+    start = time.perf_counter()
+    # Every dataset runs in its own context so that its output directory does not leak into the others
+    ok = contextvars.copy_context().run(analyse, fileName, outputDir)
+    return ok, time.perf_counter() - start
+
+def runBatch(patterns):
+    '''
+    Method to analyse many datasets, BATCH_WORKERS at a time, sharing the stage pools, the LLM client and the caches
+    Args:
+        patterns: list: files or glob patterns
+    Returns:
+        dict: file name -> (True if the analysis completed, seconds taken)
+    '''
+    batch = getBatchFiles(patterns)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        futures = {fileName: pool.submit(analyseTimed, fileName, outputDir) for fileName, outputDir in batch.items()}
+        timings = {fileName: future.result() for fileName, future in futures.items()}
+    print(f"\n|Dataset  |Output  |Status  |Seconds  |\n|------|------|------|------|")
+    for fileName, (ok, seconds) in timings.items():
+        print(f"| {fileName} | {batch[fileName]} | {'done' if ok else 'failed'} | {seconds:.1f} |")
+    print(f"Batch of {len(batch)} datasets done in {time.perf_counter() - start:.1f}s")
+    return timings
+
+def printRunReport():
+    '''
+    Method to print the cache statistics and, with IMPORT_TIME_REPORT, the import times of the run
+    '''
+    print(f"LLM cache hits: {CACHE_STATS['hits']}, misses: {CACHE_STATS['misses']}")
+    if IMPORT_TIME_REPORT:
+        printImportReport()
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Please provide the file to be analyzed")
     else:
-        analyse(sys.argv[1])
+        if len(sys.argv) == 2 and not any(char in sys.argv[1] for char in "*?["):
+            analyse(sys.argv[1])
+        else:
+            runBatch(sys.argv[1:])
+        printRunReport()
+        if TRACE_DIR:
+            exportTrace(TRACE_DIR)
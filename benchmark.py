@@ -0,0 +1,309 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#   "httpx[http2]",
+#   "pandas",
+#   "numpy",
+#   "seaborn",
+#   "chardet",
+#   "scikit-learn",
+#   "geopandas",
+#   "scipy",
+#   "matplotlib",
+#   "pyarrow",
+# ]
+# ///
+
+import pandas as pd
+import numpy as np
+import os
+import io
+import csv
+import sys
+import json
+import time
+import platform
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Grid of synthetic datasets, densities are null ratio:outlier ratio pairs
+BENCH_ROWS = [int(value) for value in os.getenv("BENCH_ROWS", "10000,100000,1000000,10000000").split(",")]
+BENCH_COLUMNS = [int(value) for value in os.getenv("BENCH_COLUMNS", "5,50,500").split(",")]
+BENCH_DENSITIES = [tuple(float(ratio) for ratio in value.split(":")) for value in os.getenv("BENCH_DENSITIES", "0:0,0.05:0.01").split(",")]
+# Datasets with more cells than this are skipped, raise it to run the whole grid
+BENCH_MAX_CELLS = float(os.getenv("BENCH_MAX_CELLS", 5e7))
+BENCH_LATENCY = float(os.getenv("BENCH_LATENCY", 0.5))
+BENCH_REPEAT = int(os.getenv("BENCH_REPEAT", 1))
+BENCH_DATA_DIR = os.getenv("BENCH_DATA_DIR", os.path.join(tempfile.gettempdir(), "autolysis_bench"))
+# Relative slowdown reported as a regression, ignored below BENCH_MIN_SECONDS of difference
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", 0.2))
+BENCH_MIN_SECONDS = float(os.getenv("BENCH_MIN_SECONDS", 0.05))
+CHUNK_ROWS = 200000
+
+def fakeArguments(payload):
+    '''
+    Method to answer a function call of autolysis the way the LLM would, without looking at the data beyond the prompt
+    Args:
+        payload: dict: chat completion payload
+    Returns:
+        dict: function call arguments
+    '''
+    functionName = payload['function_call']['name']
+    userContent = next((message['content'] for message in payload['messages'] if message['role'] == 'user'), '')
+    if functionName == 'get_column_dtypes':
+        rows = list(csv.reader(io.StringIO(userContent)))
+        metadata = []
+        for idx, name in enumerate(rows[0]):
+            values = [row[idx] for row in rows[1:] if idx < len(row) and row[idx] != '']
+            try:
+                [float(value) for value in values]
+                numeric = True
+            except ValueError:
+                numeric = False
+            metadata.append({'name': name, 'type': 'float' if numeric else 'string', 'description': name, 'min_value': 0, 'stats': numeric})
+        return {'column_metadata': metadata}
+    if functionName == 'get_intro_stats_summary':
+        return {'title': 'Benchmark', 'introduction': 'Synthetic data', 'summary': 'Synthetic data',
+                'time_series': {'isavailable': True, 'prompt': 'Plot the first numerical column'},
+                'geospatial': {'isavailable': False, 'prompt': ''}, 'network': {'isavailable': False, 'prompt': ''}}
+    if functionName == 'get_code_for_analysis':
+        code = ("import matplotlib.pyplot as plt\n"
+                "plt.figure()\n"
+                "plt.plot(df.select_dtypes('number').iloc[:, 0].to_numpy()[::max(1, len(df) // 10000)])\n"
+                "plt.savefig('time_series.png')\n"
+                "plt.close()\n")
+        return {'python_code': code, 'output_file': 'time_series.png', 'title': 'Time series', 'rationale': 'Benchmark'}
+    if functionName == 'get_feedback':
+        return {'inference': 'Benchmark', 'insights': 'Benchmark', 'recommendations': 'Benchmark'}
+    return {key: 'Benchmark' for key in ['preprocessing', 'correlation', 'outliers', 'cluster', 'summary']}
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    '''
+    OpenAI compatible chat completion endpoint answering after BENCH_LATENCY seconds
+    '''
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(BENCH_LATENCY)
+        arguments = json.dumps(fakeArguments(payload))
+        body = json.dumps({
+            'choices': [{'message': {'function_call': {'name': payload['function_call']['name'], 'arguments': arguments}}}],
+            'usage': {'prompt_tokens': len(json.dumps(payload)) // 4, 'completion_tokens': len(arguments) // 4,
+                      'total_tokens': (len(json.dumps(payload)) + len(arguments)) // 4}
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def startFakeServer():
+    '''
+    Method to start the fake LLM server on a free local port
+    Returns:
+        str: chat completion URL of the server
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+def generateDataset(rows, columns, nullRatio, outlierRatio):
+    '''
+    Method to write a synthetic CSV with a category column and numerical columns, reused if already written
+    Args:
+        rows: int: number of rows
+        columns: int: number of columns
+        nullRatio: float: ratio of missing numerical values
+        outlierRatio: float: ratio of numerical values replaced by outliers
+    Returns:
+        str: path of the CSV
+    '''
+    os.makedirs(BENCH_DATA_DIR, exist_ok=True)
+    fileName = os.path.join(BENCH_DATA_DIR, f"bench_{rows}x{columns}_{nullRatio}_{outlierRatio}.csv")
+    if os.path.exists(fileName):
+        return fileName
+    rng = np.random.default_rng(42)
+    categories = np.array(['north', 'south', 'east', 'west', 'central'])
+    tmp_path = f"{fileName}.tmp"
+    with open(tmp_path, "w") as f:
+        for start in range(0, rows, CHUNK_ROWS):
+            size = min(CHUNK_ROWS, rows - start)
+            # Every other column is correlated with the first one
+            values = rng.normal(100, 15, (size, columns - 1))
+            values[:, 1::2] = values[:, [0]] * 0.8 + values[:, 1::2] * 0.2
+            values[rng.random(values.shape) < outlierRatio] *= 10
+            values[rng.random(values.shape) < nullRatio] = np.nan
+            chunk = pd.DataFrame(values.round(3), columns=[f"x{idx}" for idx in range(1, columns)])
+            chunk.insert(0, 'region', categories[rng.integers(0, len(categories), size)])
+            chunk.to_csv(f, index=False, header=start == 0)
+    os.replace(tmp_path, fileName)
+    return fileName
+
+def timeCall(timings, name, function, *args):
+    '''
+    Method to time a call and keep its wall time, CPU time and growth of the peak resident memory
+    Args:
+        timings: dict: name -> timing, updated
+        name: str: name of the timing
+        function: function: function to call
+        args: list: arguments of the function
+    Returns:
+        object: result of the function
+    '''
+    start, cpuStart, rssStart = time.perf_counter(), time.process_time(), autolysis.getPeakRss()
+    result = function(*args)
+    timings[name] = {"wall": round(time.perf_counter() - start, 6), "cpu": round(time.process_time() - cpuStart, 6),
+                     "peak_rss_delta_mb": round(autolysis.getPeakRss() - rssStart, 3)}
+    return result
+
+def benchmarkStages(fileName):
+    '''
+    Method to time the stages of autolysis one after another on a dataset
+    Args:
+        fileName: str: path of the dataset
+    Returns:
+        dict: stage -> timing
+    '''
+    timings = {}
+    df = timeCall(timings, "loadFile", autolysis.loadFile, fileName)
+    featureInfo = timeCall(timings, "getFeatureInfo", autolysis.getFeatureInfo, df)
+    df = timeCall(timings, "applyColumnTypes", autolysis.applyColumnTypes, df, featureInfo)
+    statsInfo = timeCall(timings, "getDescriptiveStats", autolysis.getDescriptiveStats, df, featureInfo)
+    cleaned, _ = timeCall(timings, "dataPreprocessing", autolysis.dataPreprocessing, df, featureInfo, statsInfo)
+    correlationInfo = timeCall(timings, "getHighCorrelation", autolysis.getHighCorrelation, cleaned, featureInfo)
+    outliersInfo = timeCall(timings, "analyseOutliers", autolysis.analyseOutliers, cleaned, featureInfo)
+    clusterInfo = timeCall(timings, "applyKMeansClustering", autolysis.applyKMeansClustering, cleaned, featureInfo)
+    # Charts render in the background, the time left once the stages are done
+    timeCall(timings, "charts", lambda: [autolysis.getChartFile(info['output_file']) for info in (correlationInfo, outliersInfo, clusterInfo)])
+    return timings
+
+def benchmarkAnalyse(fileName, outputDir):
+    '''
+    Method to time the whole analysis of a dataset, with the time of every stage and LLM call from its trace
+    Args:
+        fileName: str: path of the dataset
+        outputDir: str: directory the README and charts are written to
+    Returns:
+        dict: timing of analyse, of its stages and the total LLM wait
+    '''
+    autolysis.TRACE_EVENTS.clear()
+    timings = {}
+    ok = timeCall(timings, "analyse", autolysis.analyse, fileName, outputDir)
+    events = list(autolysis.TRACE_EVENTS)
+    result = {**timings["analyse"], "ok": ok,
+              "stages": {event["name"]: event["wall"] for event in events if event["category"] == "stage"},
+              "llm_wait": round(sum(event["wall"] for event in events if event["category"] == "llm"), 6),
+              "llm_calls": sum(1 for event in events if event["category"] == "llm")}
+    return result
+
+def fastest(runs):
+    '''
+    Method to keep the fastest of repeated timings of every name
+    Args:
+        runs: list: dict name -> timing for every repetition
+    Returns:
+        dict: name -> fastest timing
+    '''
+    return {name: min((run[name] for run in runs), key=lambda timing: timing["wall"]) for name in runs[0]}
+
+def runBenchmark():
+    '''
+    Method to run the stage and analyse benchmarks over the grid of synthetic datasets
+    Returns:
+        list: result of every dataset
+    '''
+    results = []
+    for rows in BENCH_ROWS:
+        for columns in BENCH_COLUMNS:
+            for nullRatio, outlierRatio in BENCH_DENSITIES:
+                if rows * columns > BENCH_MAX_CELLS:
+                    print(f"Skipping {rows}x{columns}, above BENCH_MAX_CELLS")
+                    continue
+                fileName = generateDataset(rows, columns, nullRatio, outlierRatio)
+                print(f"Benchmarking {rows}x{columns} nulls {nullRatio} outliers {outlierRatio}")
+                with tempfile.TemporaryDirectory() as workDir:
+                    cwd = os.getcwd()
+                    os.chdir(workDir)
+                    try:
+                        stages = fastest([benchmarkStages(fileName) for _ in range(BENCH_REPEAT)])
+                        analyseRuns = [benchmarkAnalyse(fileName, os.path.join(workDir, f"run{idx}")) for idx in range(BENCH_REPEAT)]
+                    finally:
+                        os.chdir(cwd)
+                results.append({
+                    "rows": rows, "columns": columns, "null_ratio": nullRatio, "outlier_ratio": outlierRatio,
+                    "file_mb": round(os.path.getsize(fileName) / (1024 * 1024), 3),
+                    "stages": stages, "analyse": min(analyseRuns, key=lambda run: run["wall"])
+                })
+                for name, timing in stages.items():
+                    print(f"  {name}: {timing['wall']:.3f}s")
+                print(f"  analyse: {results[-1]['analyse']['wall']:.3f}s, LLM wait {results[-1]['analyse']['llm_wait']:.3f}s")
+    return results
+
+def getWallTimes(result):
+    '''
+    Method to get the wall times of a benchmark result to compare against a baseline
+    Args:
+        result: dict: result of a dataset
+    Returns:
+        dict: name -> wall seconds
+    '''
+    times = {name: timing["wall"] for name, timing in result["stages"].items()}
+    times["analyse"] = result["analyse"]["wall"]
+    times.update({f"analyse.{name}": wall for name, wall in result["analyse"]["stages"].items()})
+    return times
+
+def compareBaseline(results, baseline):
+    '''
+    Method to compare benchmark results with a baseline and print the regressions
+    Args:
+        results: list: results of this run
+        baseline: dict: baseline written by an earlier run
+    Returns:
+        list: regressions, dataset, name, baseline and current wall seconds
+    '''
+    getCell = lambda result: (result["rows"], result["columns"], result["null_ratio"], result["outlier_ratio"])
+    previous = {getCell(result): getWallTimes(result) for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        if getCell(result) not in previous:
+            continue
+        for name, wall in getWallTimes(result).items():
+            before = previous[getCell(result)].get(name)
+            if before is not None and wall - before > BENCH_MIN_SECONDS and wall > before * (1 + BENCH_TOLERANCE):
+                regressions.append({"dataset": "x".join(map(str, getCell(result))), "name": name, "baseline": before, "current": wall})
+    print(f"\n|Dataset  |Stage  |Baseline  |Current  |\n|------|------|------|------|")
+    for item in regressions:
+        print(f"| {item['dataset']} | {item['name']} | {item['baseline']:.3f} | {item['current']:.3f} |")
+    print(f"{len(regressions)} regressions beyond {BENCH_TOLERANCE:.0%}")
+    return regressions
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Please provide the file to write the results to, and optionally a baseline to compare with")
+        sys.exit(1)
+    # autolysis reads its settings at import, point it to the fake server and run every stage cold
+    os.environ["AISERVER_URL"] = startFakeServer()
+    os.environ.setdefault("AIPROXY_TOKEN", "benchmark")
+    os.environ.setdefault("DISABLE_CACHE", "1")
+    import autolysis
+    # Import the lazily loaded modules up front so that the first dataset is not charged for them
+    for name in ["scipy.cluster.hierarchy", "scipy.spatial.distance", "sklearn.preprocessing", "sklearn.cluster", "sklearn.metrics", "sklearn.decomposition"]:
+        autolysis.importModule(name)
+    results = runBenchmark()
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+                        "pandas": pd.__version__, "numpy": np.__version__},
+        "settings": {"latency": BENCH_LATENCY, "repeat": BENCH_REPEAT, "disable_cache": os.environ["DISABLE_CACHE"]},
+        "results": results
+    }
+    with open(sys.argv[1], "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {sys.argv[1]}")
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "r") as f:
+            regressions = compareBaseline(results, json.load(f))
+        sys.exit(1 if regressions else 0)